@@ -7,6 +7,14 @@
 #define identifier "x"              // change this to help keep track of multiple mechaduinos (printed on startup)
 
 #define STATE_UPDATE_PERIOD 20 // ms
+#define BINARY_STATE_UPDATE_PERIOD 5 // ms
+
+// Binary telemetry framing, enabled with "cb" and disabled with "ca"
+#define STATE_FRAME_SYNC_0 0xAA
+#define STATE_FRAME_SYNC_1 0x55
+#define COMMAND_FRAME_SYNC_0 0xA5
+#define COMMAND_FRAME_SYNC_1 0x5A
+#define COMMAND_FRAME_SIZE 7 // sync (2), setpoint float (4), checksum (1)
 #define HOMING_STOP_EFFORT  100
 #define HOMING_SPEED  400
 #define RAIL_TRAVEL 5120 // in encoder ticks i think
@@ -1,5 +1,7 @@
   //Contains the declaration of the state variables for the control loop  
 
+#include <stdint.h>
+#include "Parameters.h"
 
 //interrupt vars
 
@@ -46,6 +48,9 @@ volatile bool quadHoming = false;
 
 // Added for serial communication
 volatile long lastStateUpdate;
+volatile bool binaryTelemetry = false;
+volatile int stateUpdatePeriod = STATE_UPDATE_PERIOD;
+uint16_t stateSequence = 0;
 
 // Used for homing
 volatile float wrap_homing = 0;
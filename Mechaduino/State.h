@@ -3,6 +3,8 @@
 #ifndef __STATE_H__
 #define __STATE_H__
 
+#include <stdint.h>
+
 
 //interrupt vars
 
@@ -44,6 +46,9 @@ extern volatile bool quadHoming;
 // Added for serial communication
 extern volatile long lastStateUpdate;
 extern char message_buffer[80];
+extern volatile bool binaryTelemetry;
+extern volatile int stateUpdatePeriod;
+extern uint16_t stateSequence;
 
 // Used for homing
 extern volatile float wrap_homing;
@@ -2,6 +2,7 @@
 
 
 #include <SPI.h>
+#include <stddef.h>
 #include <Wire.h>
 #include <FlashStorage.h>
 
@@ -454,15 +455,67 @@ float read_angle()
 }
 
 
+// Little-endian frame sent instead of the ASCII state line when binary
+// telemetry is enabled. The checksum is the 16 bit sum of the bytes between
+// the sync bytes and the checksum itself.
+struct __attribute__((packed)) StateFrame {
+  uint8_t sync[2];
+  uint16_t sequence;
+  float cart;
+  float cartVelocity;
+  int32_t pole;
+  float poleVelocity;
+  uint16_t checksum;
+};
+
+void sendStateFrame() {
+  StateFrame frame;
+  frame.sync[0] = STATE_FRAME_SYNC_0;
+  frame.sync[1] = STATE_FRAME_SYNC_1;
+  frame.sequence = stateSequence++;
+  frame.cart = yw - RAIL_TRAVEL/2;
+  frame.cartVelocity = v;
+  frame.pole = quadEncoderTicks;
+  frame.poleVelocity = quadEncoderVelocity;
+
+  const uint8_t *bytes = (const uint8_t *) &frame;
+  uint16_t checksum = 0;
+  for (unsigned int k = 2; k < offsetof(StateFrame, checksum); k++) checksum += bytes[k];
+  frame.checksum = checksum;
+
+  SerialUSB.write(bytes, sizeof(frame));
+}
+
+void readCommandFrame() {
+  if (SerialUSB.available() < COMMAND_FRAME_SIZE) return; // wait for the rest
+
+  uint8_t bytes[COMMAND_FRAME_SIZE];
+  SerialUSB.readBytes((char *) bytes, COMMAND_FRAME_SIZE);
+
+  uint8_t checksum = bytes[2] + bytes[3] + bytes[4] + bytes[5];
+  if (bytes[1] != COMMAND_FRAME_SYNC_1 || bytes[6] != checksum) return; // drop corrupt frames
+
+  float setpoint;
+  memcpy(&setpoint, bytes + 2, sizeof(setpoint));
+  r = setpoint;
+}
+
 void serialCheckGym() {
-  if (millis() - STATE_UPDATE_PERIOD >= lastStateUpdate) {
+  if (millis() - stateUpdatePeriod >= lastStateUpdate) {
       lastStateUpdate = millis();
 
-      sprintf(message_buffer,"%f %f %ld %f\n", yw - RAIL_TRAVEL/2, v, quadEncoderTicks, quadEncoderVelocity);
-      SerialUSB.print(message_buffer);
+      if (binaryTelemetry) sendStateFrame();
+      else {
+        sprintf(message_buffer,"%f %f %ld %f\n", yw - RAIL_TRAVEL/2, v, quadEncoderTicks, quadEncoderVelocity);
+        SerialUSB.print(message_buffer);
+      }
   }
   
-  if (SerialUSB.available()) {
+  if (binaryTelemetry && SerialUSB.available() && SerialUSB.peek() == COMMAND_FRAME_SYNC_0) {
+    readCommandFrame();
+  }
+
+  else if (SerialUSB.available()) {
     long start = millis();
     String s = SerialUSB.readStringUntil('\r');
 
@@ -489,6 +542,18 @@ void serialCheckGym() {
         // Switch to velocity mode
         mode = 'v';
       }
+
+      else if (s.charAt(1) == 'b') {
+        // Switch to binary state and command frames
+        binaryTelemetry = true;
+        stateUpdatePeriod = BINARY_STATE_UPDATE_PERIOD;
+      }
+
+      else if (s.charAt(1) == 'a') {
+        // Switch back to ASCII state lines and commands
+        binaryTelemetry = false;
+        stateUpdatePeriod = STATE_UPDATE_PERIOD;
+      }
       
     }
 
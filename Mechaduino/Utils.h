@@ -22,6 +22,10 @@
 
   void serialCheckGym();
 
+  void sendStateFrame();
+
+  void readCommandFrame();
+
   void configureStepDir();          //configure step/dir interface
   
   void configureEnablePin();        //configure enable pin 
@@ -0,0 +1,81 @@
+import argparse, time
+import numpy as np
+
+from env import HillCartpole, ForceMap, TORQUE_SCALING
+
+# Measures how hard the cart accelerates for a sweep of torque commands and
+# saves a monotone ForceMap, which HillCartpole(force_map=...) uses to make
+# force linear in the action.
+#
+#     python3 calibration.py force_map.npz
+#
+# Every command starts from a homed cart, and is cut off early if the cart
+# gets near the end of the rail.
+
+MAX_COMMAND   = 1.2 * TORQUE_SCALING
+NUM_COMMANDS  = 49
+SAMPLES       = 15 # states read while each command is held
+POSITION_STOP = 0.6
+
+def measure_acceleration(env, command, samples=SAMPLES):
+    env.reset() # homes the cart to the middle of the rail
+    env.command(command)
+
+    times, velocities = [], []
+    for _ in range(samples):
+        q = env.read_state()
+        times.append(time.monotonic() - env.observation_age)
+        velocities.append(q[1])
+
+        if abs(q[0]) > POSITION_STOP:
+            break
+
+    env.command(0)
+
+    # The first sample may predate the command, so fit the slope without it.
+    if len(times) < 3:
+        return 0.0
+
+    return np.polyfit(times[1:], velocities[1:], 1)[0]
+
+def isotonic(values):
+    # Pool adjacent violators, giving the closest nondecreasing sequence.
+    blocks = []
+    for value in values:
+        blocks.append([value, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            value, count = blocks.pop()
+            blocks[-1][0] = (blocks[-1][0] * blocks[-1][1] + value * count) / (blocks[-1][1] + count)
+            blocks[-1][1] += count
+
+    return np.concatenate([np.full(count, value) for value, count in blocks])
+
+def calibrate(env, commands, verbose=False):
+    accelerations = []
+    for command in commands:
+        accelerations.append(measure_acceleration(env, command))
+
+        if verbose:
+            print(f'Command {command:7.2f}: acceleration {accelerations[-1]:.4f}')
+
+    # Readings are noisy, so keep the closest monotone map.
+    accelerations = isotonic(np.array(accelerations))
+    return ForceMap(commands, accelerations)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the command to force map of the robot.')
+    parser.add_argument('output', help='force map .npz file to write')
+    parser.add_argument('--max-command', type=float, default=MAX_COMMAND)
+    parser.add_argument('--num-commands', type=int, default=NUM_COMMANDS)
+    args = parser.parse_args()
+
+    env = HillCartpole(verbose=True)
+    if not env.real:
+        raise SystemExit('Calibration needs the physical robot.')
+
+    commands = np.linspace(-args.max_command, args.max_command, args.num_commands)
+    force_map = calibrate(env, commands, verbose=True)
+    force_map.save(args.output)
+
+    print(f'Saved force map to {args.output}, '
+          f'max symmetric acceleration {force_map.max_acceleration:.4f}.')
@@ -6,9 +6,10 @@ from pydantic import BaseModel
 from pathlib import Path
 import os
 import daemon
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 import pandas
 import json
+import sys
 
 HOST_FILE = os.path.join(Path.home(),".the_hill/host.txt")
 CODE_FILE = os.path.join(Path.home(), ".the_hill/code.zip")
@@ -44,29 +45,31 @@ def json_print(js, hide = True):
         out = pandas.json_normalize(empty)
     out.set_index('id', inplace = True)
     if hide:
-        out.drop(columns = ['logs'], inplace = True)
+        out.drop(columns = ['logs'], inplace = True, errors = 'ignore')
     typer.echo(out)
 
 
 @app.command()
 def queue(robotname: str = typer.Option(None), 
+            limit: int = typer.Option(100, help = "most jobs to list"),
             url: str = typer.Option(stored_values["url_name"], prompt = True)): 
     set_host(url)
     endpoint = url + '/queue/'
     if robotname is not None:
         endpoint += robotname
-    r = requests.get(endpoint)
+    r = requests.get(endpoint, params = {'limit': limit})
     json_print(r.json())
 
 
 @app.command()
 def history(robotname: str = typer.Option(None), 
+            limit: int = typer.Option(100, help = "most jobs to list"),
             url: str = typer.Option(stored_values["url_name"], prompt = True)): 
     set_host(url)
     endpoint = url + '/history/'
     if robotname is not None:
         endpoint += robotname
-    r = requests.get(endpoint)
+    r = requests.get(endpoint, params = {'limit': limit})
     json_print(r.json())
 
 @job_app.command("create")
@@ -79,23 +82,42 @@ def job_create(container: str = typer.Option(stored_values["container"], prompt
     update(container, mount, robotname, codezip, runcommand, url)
     endpoint = url + '/job/'
     if os.path.isdir(codezip):  
-        with ZipFile(CODE_FILE, 'w') as f:
-           for folderName, subfolders, filenames in os.walk(codezip):
-               for filename in filenames:
-                   filePath = os.path.join(folderName, filename)
-                   f.write(filePath)
-        f = open(CODE_FILE, "rb")
+        zip_directory(codezip, CODE_FILE)
+        zip_path = CODE_FILE
     else :  
-        f= open(codezip,"rb")
+        zip_path = codezip
 
-    r = requests.post(endpoint, params = {
+    params = {
         'container': container,
         'mount': mount,
         'robot': robotname,
-        'run_command': runcommand
-    }, files = {'code_zip': f})
+        'run_command': runcommand,
+        'code_hash': daemon.file_hash(zip_path) # the same hash the daemon checks
+    }
+
+    # Only upload the code if the server doesn't already have the same zip.
+    r = None
+    if requests.get(url + '/blob/' + params['code_hash']).ok:
+        r = requests.post(endpoint, params = params)
+
+    if r is None or r.status_code == 404:
+        with open(zip_path, "rb") as f:
+            r = requests.post(endpoint, params = params, files = {'code_zip': f})
+
     json_print(r.json())
-    f.close()
+
+def zip_directory(directory, zip_path):
+    # Same files in, same bytes out, so unchanged code hashes the same and
+    # is not uploaded again.
+    with ZipFile(zip_path, 'w') as f:
+        for folderName, subfolders, filenames in os.walk(directory):
+            subfolders.sort()
+            for filename in sorted(filenames):
+                filePath = os.path.join(folderName, filename)
+                info = ZipInfo.from_file(filePath)
+                info.date_time = (1980, 1, 1, 0, 0, 0)
+                with open(filePath, 'rb') as source:
+                    f.writestr(info, source.read())
 
 def update(container, mount, robot_name, code_zip, run_command, url):
     stored_values["container"] = container
@@ -121,6 +143,25 @@ def job_read(jobid : int = typer.Option(None, prompt = True),
     r = requests.get(endpoint)
     json_print(r.json(), False)
     
+@job_app.command("logs") 
+def job_logs(jobid : int = typer.Option(None, prompt = True),  
+            follow: bool = typer.Option(False, help = "keep printing output until the job ends"),
+            url: str = typer.Option(stored_values["url_name"], prompt = True)):
+    set_host(url)
+    endpoint = url + '/job/' + str(jobid) + '/logs'
+    with requests.get(endpoint, params = {'follow': follow}, stream = True) as r:
+        for chunk in r.iter_content(chunk_size = None):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+    
+@job_app.command("cancel") 
+def job_cancel(jobid : int = typer.Option(None, prompt = True), 
+            url: str = typer.Option(stored_values["url_name"], prompt = True)):
+    set_host(url)
+    endpoint = url + '/job/' + str(jobid) + '/cancel'
+    r = requests.post(endpoint)
+    json_print(r.json())
+
 @job_app.command("delete") 
 def job_delete(jobid : int = typer.Option(None, prompt = True), 
             url: str = typer.Option(stored_values["url_name"], prompt = True)):
@@ -1,43 +1,212 @@
 import docker
 from docker.types import Mount
+from docker.utils import parse_repository_tag
 import requests
-import time, os, shutil
+import time, os, shutil, uuid, random, hashlib, threading, queue, json
 from pathlib import Path
 import urllib.request
 import zipfile
 
-WORKSPACE_DIR = os.path.join(Path.home(),".the_hill/workspace")
+WORKSPACES_DIR = os.path.join(Path.home(),".the_hill/workspaces")
+FAILED_DIR = os.path.join(Path.home(),".the_hill/failed")
+CODE_CACHE_DIR = os.path.join(Path.home(),".the_hill/code_cache")
+MAX_CODE_CACHE_SIZE = 2 << 30 # bytes of extracted code kept across jobs
+POP_WAIT = 25 # seconds the server holds an idle pop open
+MAX_BACKOFF = 30
+PREFETCH_INTERVAL = 30 # seconds between checks of the robot's queue
+PREFETCH_JOBS = 5 # upcoming jobs whose images are pulled ahead of time
+LOG_FLUSH_INTERVAL = 1 # seconds between sends of new log output
+LOG_CHUNK_SIZE = 1 << 20
+STATUS_WAIT = 25 # seconds the server holds a wait on a running job open
+UPLOAD_TIMEOUT = 60 # seconds a log or result upload may go without a response
 
-def pop_job(robot_name, url): 
+def pop_job(robot_name, url, wait=POP_WAIT): 
     endpoint = url + '/pop/' + robot_name    
-    return requests.post(endpoint).json()
 
-def get_job(job, url):
-    endpoint = url + '/job/' + str(job['id'])   
-    return requests.get(endpoint).json()
+    # Retries send the same owner token, so if a response is lost the server
+    # hands back the job it already claimed instead of claiming another.
+    owner = uuid.uuid4().hex
+    backoff = 1
+    while True:
+        try:
+            r = requests.post(endpoint,
+                              params={'owner': owner, 'wait': wait},
+                              timeout=wait + 10)
+            r.raise_for_status()
+            return r.json()
+        except requests.exceptions.RequestException as e:
+            print(f'Could not reach the server ({e}), retrying in {backoff} s.')
+            time.sleep(backoff * random.uniform(1, 1.5))
+            backoff = min(2 * backoff, MAX_BACKOFF)
+
+class CodeCache:
+    """
+    Extracted code trees kept on disk by the hash of their zip, so that a
+    robot running the same code again doesn't download and extract it again.
+    The least recently used trees are removed once they take up more than
+    max_size bytes.
+    """
+
+    def __init__(self, directory=CODE_CACHE_DIR, max_size=MAX_CODE_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+        # Leftovers from an interrupted download are not in the cache.
+        self.sizes = {}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                self.sizes[name] = tree_size(path)
+
+    def get(self, code_hash, code_url):
+        path = os.path.join(self.directory, code_hash)
+        if code_hash in self.sizes:
+            os.utime(path) # marks it as recently used
+            return path
+
+        # Download and extract next to the cache, then move it in whole.
+        temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        os.makedirs(temp)
+        try:
+            zipfile_path = os.path.join(temp, 'code.zip')
+            urllib.request.urlretrieve(code_url, zipfile_path)
+            if file_hash(zipfile_path) != code_hash:
+                raise ValueError(f'Downloaded code does not match hash {code_hash}.')
+
+            with zipfile.ZipFile(zipfile_path, 'r') as f:
+                f.extractall(os.path.join(temp, 'code'))
+
+            os.rename(os.path.join(temp, 'code'), path)
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+
+        self.sizes[code_hash] = tree_size(path)
+        self.evict(keep=code_hash)
+        return path
+
+    def evict(self, keep):
+        by_age = sorted(
+            self.sizes, key=lambda name: os.path.getmtime(os.path.join(self.directory, name))
+        )
+        for name in by_age:
+            if sum(self.sizes.values()) <= self.max_size:
+                break
+
+            if name != keep:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                del self.sizes[name]
+
+def tree_size(path):
+    return sum(
+        os.path.getsize(os.path.join(folder, filename))
+        for folder, _, filenames in os.walk(path) for filename in filenames
+    )
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ImagePrefetcher(threading.Thread):
+    """
+    Pulls the container images of the robot's next queued jobs in the
+    background, so that they are ready by the time the jobs start.
+    """
+
+    def __init__(self, robot_name, url, interval=PREFETCH_INTERVAL):
+        super().__init__(daemon=True)
+        self.robot_name = robot_name
+        self.url = url
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def run(self):
+        client = docker.from_env()
+        while True:
+            try:
+                for image in self.upcoming_images():
+                    self.pull(client, image)
+            except Exception as e:
+                print(f'Could not prefetch images ({e}).')
+
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def upcoming_images(self):
+        queue = requests.get(self.url + '/queue/' + self.robot_name, timeout=30).json()
+        images = []
+        for job in queue[:PREFETCH_JOBS]:
+            if job['container'] not in images:
+                images.append(job['container'])
+        return images
+
+    def pull(self, client, image):
+        try:
+            client.images.get(image)
+            return
+        except docker.errors.ImageNotFound:
+            pass
+
+        print(f'Pulling {image} for an upcoming job...')
+        repository, tag = parse_repository_tag(image)
+        client.images.pull(repository, tag=tag or 'latest')
+
+def workspace_dir(job):
+    # Each job gets its own workspace, so one can be uploading while the
+    # next job runs.
+    return os.path.join(WORKSPACES_DIR, str(job['id']))
+
+def prepare_workspace(job, url, cache=None):
+    workspace = workspace_dir(job)
 
-def prepare_workspace(job, url):
     # Delete workspace folder to clear
-    if os.path.exists(WORKSPACE_DIR):
-        shutil.rmtree(WORKSPACE_DIR)
+    if os.path.exists(workspace):
+        shutil.rmtree(workspace)
+
+    # Then create it, along with the directory for output
+    os.makedirs(workspace)
+    os.makedirs(os.path.join(workspace,"output"))
 
-    # Then create it, along with directories for output and code
-    os.makedirs(WORKSPACE_DIR)
-    os.makedirs(os.path.join(WORKSPACE_DIR,"code"))
-    os.makedirs(os.path.join(WORKSPACE_DIR,"output"))
+    # Code the robot has run before is copied from the cache. The job can
+    # change its copy, so the cached tree itself is never mounted.
+    code_url = url + '/code/' + str(job['id'])
+    if cache is not None and job.get('code_hash'):
+        shutil.copytree(
+            cache.get(job['code_hash'], code_url),
+            os.path.join(workspace,"code")
+        )
+        return workspace
+
+    os.makedirs(os.path.join(workspace,"code"))
 
     # Now, we download the code zip.
-    zipfile_path = os.path.join(WORKSPACE_DIR,'code.zip')
+    zipfile_path = os.path.join(workspace,'code.zip')
     urllib.request.urlretrieve(
-        url + '/code/' + str(job['id']), 
+        code_url, 
         zipfile_path
     )
     
     # And extract it into the code directory.
     with zipfile.ZipFile(zipfile_path, 'r') as f:
-        f.extractall(os.path.join(WORKSPACE_DIR,"code"))
+        f.extractall(os.path.join(workspace,"code"))
+
+    return workspace
 
-def run_job(client, job, url):
+def fail_workspace(job, error):
+    # Leaves an empty output folder and a log saying why the job couldn't
+    # run, for the uploader to send as its results.
+    workspace = workspace_dir(job)
+    os.makedirs(os.path.join(workspace, 'output'), exist_ok=True)
+    with open(os.path.join(workspace, 'log.txt'), 'a') as f:
+        f.write(f'Could not prepare the job: {error}\n')
+    return workspace
+
+def run_job(client, job, url, workspace):
     c = client.containers.run(
         job['container'],
         job['run_command'],
@@ -45,29 +214,137 @@ def run_job(client, job, url):
         privileged=True,
         working_dir='/code',
         volumes={
-            os.path.join(WORKSPACE_DIR,'code'):{'bind':'/code', 'mode': 'rw'},
-            os.path.join(WORKSPACE_DIR,'output'):{'bind':'/out', 'mode': 'rw'},
+            os.path.join(workspace,'code'):{'bind':'/code', 'mode': 'rw'},
+            os.path.join(workspace,'output'):{'bind':'/out', 'mode': 'rw'},
             '/dev':{'bind':'/dev', 'mode': 'rw'} # for USB serial
         }
     )
     
-    c.reload()
-    while c.status != 'exited':
-        time.sleep(1)
-        job = get_job(job, url)
-        if job['status'] == 'cancelled':
-            c.stop()
+    logs = LogStreamer(c, job, url, workspace)
+    logs.start()
+
+    watcher = CancelWatcher(c, job, url)
+    watcher.start()
 
-        c.reload()
+    c.wait()
+    watcher.done.set()
 
-    job['logs'] = c.logs(timestamps=True).decode("utf-8")
+    logs.join()
     c.remove()
 
+    if watcher.cancelled:
+        job = dict(job, status='cancelled')
+
     return job
+
+class CancelWatcher(threading.Thread):
+    """
+    Holds a request open on the server until the running job's status
+    changes, and stops the container as soon as the job is cancelled or
+    deleted.
+    """
+
+    def __init__(self, container, job, url):
+        super().__init__(daemon=True)
+        self.container = container
+        self.endpoint = url + '/job/' + str(job['id']) + '/wait'
+        self.done = threading.Event()
+        self.cancelled = False
+
+    def run(self):
+        backoff = 1
+        while not self.done.is_set():
+            try:
+                r = requests.get(self.endpoint,
+                                 params={'status': 'running', 'timeout': STATUS_WAIT},
+                                 timeout=STATUS_WAIT + 10)
+                if r.status_code == 404:
+                    status = 'cancelled' # the job was deleted
+                else:
+                    r.raise_for_status()
+                    status = r.json()['status']
+
+                if status == 'running':
+                    backoff = 1
+                    continue
+
+                if status == 'cancelled' and not self.done.is_set():
+                    self.cancelled = True
+                    self.container.stop()
+                return
+            except (requests.exceptions.RequestException, docker.errors.APIError) as e:
+                print(f'Could not wait on job status ({e}), retrying in {backoff} s.')
+                self.done.wait(backoff * random.uniform(1, 1.5))
+                backoff = min(2 * backoff, MAX_BACKOFF)
+
+class LogStreamer(threading.Thread):
+    """
+    Copies a container's output into log.txt in the workspace as it is
+    written, and sends what is new to the server every second. Whatever
+    could not be sent is sent with the job's results.
+    """
+
+    def __init__(self, container, job, url, workspace):
+        super().__init__(daemon=True)
+        self.container = container
+        self.job = job
+        self.url = url
+        self.path = os.path.join(workspace, 'log.txt')
+        self.sent = 0
+
+    def run(self):
+        # Created before the copier starts, so there is always a log to send.
+        open(self.path, 'ab').close()
+        copier = threading.Thread(target=self.copy, daemon=True)
+        copier.start()
+
+        while True:
+            done = not copier.is_alive()
+            try:
+                self.sent = send_logs(self.job, self.url, self.path, self.sent)
+            except requests.exceptions.RequestException:
+                pass # tried again next time, or by the uploader
+
+            if done:
+                return
+            copier.join(LOG_FLUSH_INTERVAL)
+
+    def copy(self):
+        with open(self.path, 'ab') as f:
+            for chunk in self.container.logs(stream=True, follow=True, timestamps=True):
+                f.write(chunk)
+                f.flush()
+
+def send_logs(job, url, path, offset=None):
+    # Appends the part of the log file the server doesn't have yet, and
+    # returns how much it now has. With offset None, asks the server first.
+    endpoint = url + '/job/' + str(job['id']) + '/logs'
+    if offset is None:
+        r = requests.post(endpoint, params={'offset': 0}, timeout=UPLOAD_TIMEOUT)
+        r.raise_for_status()
+        offset = r.json()['size']
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            chunk = f.read(LOG_CHUNK_SIZE)
+            if not chunk:
+                return offset
+
+            r = requests.post(endpoint, params={'offset': offset}, data=chunk,
+                              timeout=UPLOAD_TIMEOUT)
+            if r.status_code == 409:
+                # The server has less than we thought, so start again from there.
+                offset = r.json()['size']
+                f.seek(offset)
+                continue
+
+            r.raise_for_status()
+            offset = r.json()['size']
        
-def push_job(job, url):
+def push_job(job, url, workspace):
     # First, we zip the contents of the output directory.
-    zip_dir = os.path.join(WORKSPACE_DIR,'output')
+    zip_dir = os.path.join(workspace,'output')
     shutil.make_archive(
         zip_dir, 'zip', zip_dir
     )
@@ -77,29 +354,134 @@ def push_job(job, url):
     if job['status'] != 'cancelled':
         job['status']  = 'finished'
 
-    out_zip = open(zip_dir+'.zip', "rb")
-    
-    requests.put(endpoint, params = {
-        'job_id': job['id'],
-        'job_status': job['status']
-    }, files = {
-        'output_zip': out_zip,
-        'job_logs':('log.txt', job['logs'])
-    })
+    # Send any logs that didn't make it while the job was running.
+    log_path = os.path.join(workspace, 'log.txt')
+    if os.path.exists(log_path):
+        send_logs(job, url, log_path)
+
+    with open(zip_dir+'.zip', "rb") as out_zip:
+        r = requests.put(endpoint, params = {
+            'job_id': job['id'],
+            'job_status': job['status']
+        }, files = {
+            'output_zip': out_zip
+        }, timeout=UPLOAD_TIMEOUT)
+    r.raise_for_status()
+
+class Uploader(threading.Thread):
+    """
+    Zips and uploads the results of finished jobs in the background, so the
+    robot can start its next job straight away. Uploads are retried with
+    backoff until the server takes them, and each finished job is saved in
+    its workspace so that uploads cut short by a restart are resumed.
+    Results the server refuses, or that can't be read, are moved to
+    FAILED_DIR instead, and those of deleted jobs are dropped.
+    """
+
+    def __init__(self, url):
+        super().__init__(daemon=True)
+        self.url = url
+        self.jobs = queue.Queue()
+
+    def submit(self, job, workspace):
+        with open(os.path.join(workspace, 'job.json'), 'w') as f:
+            json.dump(job, f)
+        self.jobs.put((job, workspace))
+
+    def resume(self):
+        # Finished jobs left over from the last run are uploaded again, and
+        # workspaces of jobs that never finished are removed.
+        if not os.path.exists(WORKSPACES_DIR):
+            return
+
+        for name in sorted(os.listdir(WORKSPACES_DIR)):
+            workspace = os.path.join(WORKSPACES_DIR, name)
+            job_file = os.path.join(workspace, 'job.json')
+
+            if os.path.exists(job_file):
+                with open(job_file) as f:
+                    self.jobs.put((json.load(f), workspace))
+            else:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    def run(self):
+        while True:
+            job, workspace = self.jobs.get()
+            self.upload(job, workspace)
+
+    def upload(self, job, workspace):
+        backoff = 1
+        while True:
+            try:
+                push_job(job, self.url, workspace)
+                break
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code == 404:
+                    print(f'Job {job["id"]} was deleted, dropping its results.')
+                    shutil.rmtree(workspace, ignore_errors=True)
+                    return
+                if e.response.status_code < 500:
+                    print(f'Server refused the results of job {job["id"]} ({e}).')
+                    self.keep_failed(job, workspace)
+                    return
+                error = e
+            except requests.exceptions.RequestException as e:
+                error = e
+            except OSError as e:
+                # Retrying won't bring back a missing or unreadable workspace.
+                print(f'Could not read the results of job {job["id"]} ({e}).')
+                self.keep_failed(job, workspace)
+                return
+
+            print(f'Could not upload job {job["id"]} ({error}), retrying in {backoff} s.')
+            time.sleep(backoff * random.uniform(1, 1.5))
+            backoff = min(2 * backoff, MAX_BACKOFF)
+
+        shutil.rmtree(workspace, ignore_errors=True)
+        print(f'Uploaded job {job["id"]}.')
+
+    def keep_failed(self, job, workspace):
+        # Moved out of the workspaces, so the upload isn't resumed on restart.
+        if not os.path.exists(workspace):
+            return
+
+        os.makedirs(FAILED_DIR, exist_ok=True)
+        failed = os.path.join(FAILED_DIR, os.path.basename(workspace))
+        shutil.rmtree(failed, ignore_errors=True)
+        shutil.move(workspace, failed)
+        print(f'Kept the results of job {job["id"]} in {failed}.')
 
 
 def run(robot_name, url):
     client = docker.from_env()
+    cache = CodeCache()
+
+    prefetcher = ImagePrefetcher(robot_name, url)
+    prefetcher.start()
+
+    uploader = Uploader(url)
+    uploader.resume()
+    uploader.start()
     
     while True:
-        time.sleep(1)
-        
+        start = time.monotonic()
         job = pop_job(robot_name, url)
         if job is None:
+            # Servers without long polling answer straight away.
+            time.sleep(max(0, 1 - (time.monotonic() - start)))
             continue
         
         print(f'Running job {job["id"]}...')
-        prepare_workspace(job, url) # setup workspace
-        completed_job = run_job(client, job, url) # run job
-        push_job(completed_job, url) # push job to server
-        print(f'Finished job {job["id"]}!')    
\ No newline at end of file
+        prefetcher.wakeup.set() # the queue just changed
+        try:
+            workspace = prepare_workspace(job, url, cache) # setup workspace
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            # Downloads that fail or don't match their hash finish the job
+            # with the error as its log, instead of leaving it running.
+            print(f'Could not prepare job {job["id"]} ({e}).')
+            uploader.submit(job, fail_workspace(job, e))
+            continue
+
+        completed_job = run_job(client, job, url, workspace) # run job
+        uploader.submit(completed_job, workspace) # push job to server in the background
+        print(f'Finished job {job["id"]}!')
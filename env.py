@@ -1,4 +1,4 @@
-import serial, sys, glob, gym, time, os
+import serial, sys, glob, gym, time, os, threading, struct, json, math, queue
 import serial.tools.list_ports
 import numpy as np
 
@@ -16,9 +16,799 @@ CART_MASS             = 0.5 # kg
 POLE_MASS             = 0.05 # kg
 POLE_LENGTH           = 0.2 # m
 GRAVITY               = -9.81 # m/s^2
+FORCE_SCALING         = 1 # N per unit action in simulation
+
+INTEGRATORS           = ('euler', 'semi_implicit', 'rk4', 'adaptive')
+ADAPTIVE_RTOL         = 1e-4
+ADAPTIVE_ATOL         = 1e-6
+ADAPTIVE_MIN_STEP     = 1e-9 # s, below which the adaptive integrator gives up
+
+SERIAL_TIMEOUT        = 0.1 # s, how long the reader thread blocks per line
+HOMING_QUIET          = 0.25 # s without samples, after which the robot is homing
+STATE_BUFFER_SIZE     = 1024
+TIMING_BUFFER_SIZE    = 4096
+FORCE_LOOKUP_SIZE     = 2049 # entries over the action range [-1, 1]
+RECORD_CHUNK_ROWS     = 1 << 16
+
+# Binary telemetry, see sendStateFrame and readCommandFrame in the firmware.
+STATE_FRAME_SYNC      = b'\xaa\x55'
+STATE_FRAME           = np.dtype([
+    ('sync', 'V2'), ('sequence', '<u2'),
+    ('cart', '<f4'), ('cart_velocity', '<f4'),
+    ('pole', '<i4'), ('pole_velocity', '<f4'),
+    ('checksum', '<u2')
+])
+COMMAND_FRAME_SYNC    = b'\xa5\x5a'
+COMMAND_FRAME         = struct.Struct('<2s4sB')
 
 gym.logger.set_level(40)
 
+def cartpole_reward(q, windup_penalty):
+    # A single state uses float math, since ufuncs on 0-d arrays allocate.
+    if q.ndim == 1:
+        theta = float(q[2])
+        cos, sqrt = math.cos, math.sqrt
+    else:
+        theta = q[..., 2]
+        cos, sqrt = np.cos, np.sqrt
+
+    # Give reward from 0 to 1 for pole position.
+    # Could also penalize x position, but will not for now.
+    reward = 0.5 * (1-cos(theta))
+
+    # penalty on sqrt of total angular distance, meant to dissuade
+    # helicopter policies.
+    reward -= windup_penalty * sqrt(abs(theta))
+
+    return reward
+
+def trig_observation(q, out=None):
+    if out is None:
+        out = np.empty(q.shape[:-1] + (5,))
+
+    out[..., 0] = q[..., 0]
+    out[..., 1] = q[..., 1]
+    np.cos(q[..., 2], out=out[..., 2])
+    np.sin(q[..., 2], out=out[..., 3])
+    out[..., 4] = q[..., 3]
+
+    return out
+
+class CartpoleSimulator:
+    """
+    Simulates N independent carts at once. The state is an (N, 4) array of
+    [x, xdot, theta, thetadot] rows, and masses and pole lengths are kept per
+    cart so that each one can be given different dynamics.
+
+    `integrator` is one of INTEGRATORS. The fixed-step ones take `substeps`
+    steps of `dt` per call to `step`, while "adaptive" covers the same
+    interval with an embedded Bogacki-Shampine 3(2) pair, choosing its own
+    step size to keep the local error of every cart within tolerance.
+
+    The state and all intermediate results live in buffers allocated here, so
+    stepping with a fixed-step integrator allocates no arrays.
+    """
+
+    def __init__(
+        self,
+        num_envs=1,
+        cart_mass = CART_MASS,
+        pole_mass = POLE_MASS,
+        pole_length = POLE_LENGTH,
+        dt = 1/SIMULATION_FREQUENCY,
+        integrator = 'semi_implicit',
+        force_scaling = FORCE_SCALING
+    ):
+        if integrator not in INTEGRATORS:
+            raise ValueError(f'Unknown integrator "{integrator}".')
+
+        self.num_envs = num_envs
+        self.dt = dt
+        self.integrator = integrator
+        self.adaptive_dt = dt
+        self.q = np.zeros((num_envs, 4))
+
+        self.cart_mass = np.empty(num_envs)
+        self.pole_mass = np.empty(num_envs)
+        self.pole_length = np.empty(num_envs)
+        self.force_scaling = np.empty(num_envs)
+
+        self.cart_mass[:] = cart_mass
+        self.pole_mass[:] = pole_mass
+        self.pole_length[:] = pole_length
+        self.force_scaling[:] = force_scaling
+
+        # Scratch space for accelerations and the multi-stage integrators.
+        self.scratch = np.empty((6, num_envs))
+        self.k = np.empty((4, num_envs, 4))
+        self.q_stage = np.empty((num_envs, 4))
+        self.q_error = np.empty((num_envs, 4))
+
+    def reset(self, mask=None):
+        if mask is None:
+            self.q[:] = 0
+        else:
+            self.q[mask] = 0
+
+    def accelerations(self, q, u, x_dotdot, theta_dotdot):
+        sin_theta, cos_theta, thetadot_sq, denominator, force, tmp = self.scratch
+        np.multiply(u, self.force_scaling, out=force)
+
+        # The dynamics are written for a flipped pole angle.
+        np.sin(q[:, 2], out=sin_theta)
+        np.negative(sin_theta, out=sin_theta)
+        np.cos(q[:, 2], out=cos_theta)
+        np.multiply(q[:, 3], q[:, 3], out=thetadot_sq)
+
+        # cart_mass + pole_mass * sin(theta)**2
+        np.multiply(sin_theta, sin_theta, out=denominator)
+        denominator *= self.pole_mass
+        denominator += self.cart_mass
+
+        # (u + pole_mass * sin(theta) * (
+        #     pole_length * thetadot**2 + GRAVITY * cos(theta)
+        # )) / denominator
+        np.multiply(thetadot_sq, self.pole_length, out=x_dotdot)
+        np.multiply(cos_theta, GRAVITY, out=tmp)
+        x_dotdot += tmp
+        x_dotdot *= sin_theta
+        x_dotdot *= self.pole_mass
+        x_dotdot += force
+        x_dotdot /= denominator
+
+        # (-u*cos(theta) -
+        #  pole_mass * pole_length * thetadot**2 * cos(theta) * sin(theta) -
+        #  (cart_mass + pole_mass) * GRAVITY * sin(theta)
+        # ) / (pole_length * denominator)
+        np.multiply(cos_theta, force, out=theta_dotdot)
+        np.negative(theta_dotdot, out=theta_dotdot)
+        np.multiply(thetadot_sq, cos_theta, out=tmp)
+        tmp *= sin_theta
+        tmp *= self.pole_mass
+        tmp *= self.pole_length
+        theta_dotdot -= tmp
+        np.add(self.cart_mass, self.pole_mass, out=tmp)
+        tmp *= GRAVITY
+        tmp *= sin_theta
+        theta_dotdot -= tmp
+        np.multiply(denominator, self.pole_length, out=tmp)
+        theta_dotdot /= tmp
+
+    def derivative(self, q, u, out=None):
+        if out is None:
+            out = np.empty_like(q)
+
+        out[:, 0] = q[:, 1]
+        out[:, 2] = q[:, 3]
+        self.accelerations(q, u, out[:, 1], out[:, 3])
+
+        return out
+
+    def step(self, u, substeps=1):
+        if self.integrator == 'adaptive':
+            self.step_adaptive(u, substeps * self.dt)
+            return
+
+        for _ in range(substeps):
+            if self.integrator == 'semi_implicit':
+                self.step_semi_implicit(u)
+            elif self.integrator == 'euler':
+                self.step_euler(u)
+            else:
+                self.step_rk4(u)
+
+    def step_semi_implicit(self, u):
+        qdotdot = self.k[0]
+        self.accelerations(self.q, u, qdotdot[:, 0], qdotdot[:, 1])
+
+        # Euler integration, updating velocities before positions.
+        qdotdot *= self.dt
+        self.q[:, 1::2] += qdotdot[:, :2]
+        np.multiply(self.q[:, 1::2], self.dt, out=qdotdot[:, :2])
+        self.q[:, ::2] += qdotdot[:, :2]
+
+    def step_euler(self, u):
+        k1 = self.derivative(self.q, u, self.k[0])
+        k1 *= self.dt
+        self.q += k1
+
+    def step_rk4(self, u):
+        dt = self.dt
+        k1, k2, k3, k4 = self.k
+        q_stage = self.q_stage
+
+        self.derivative(self.q, u, k1)
+        for k_prev, k_next, fraction in ((k1, k2, dt/2), (k2, k3, dt/2), (k3, k4, dt)):
+            np.multiply(k_prev, fraction, out=q_stage)
+            q_stage += self.q
+            self.derivative(q_stage, u, k_next)
+
+        # q += dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+        k2 += k3
+        k2 *= 2
+        k1 += k2
+        k1 += k4
+        k1 *= dt/6
+        self.q += k1
+
+    def step_adaptive(self, u, duration):
+        t = 0.0
+        k1, k2, k3, k4 = self.k
+        q_new, error = self.q_stage, self.q_error
+        self.derivative(self.q, u, k1)
+
+        while t < duration:
+            h = min(self.adaptive_dt, duration - t)
+
+            self.derivative(self.q + h/2 * k1, u, k2)
+            self.derivative(self.q + 3*h/4 * k2, u, k3)
+            np.add(self.q, h * (2/9 * k1 + 1/3 * k2 + 4/9 * k3), out=q_new)
+            self.derivative(q_new, u, k4)
+
+            np.multiply(h, -5/72 * k1 + 1/12 * k2 + 1/9 * k3 - 1/8 * k4, out=error)
+            scale = ADAPTIVE_ATOL + ADAPTIVE_RTOL * np.maximum(
+                np.abs(self.q), np.abs(q_new)
+            )
+            error_norm = np.max(np.abs(error) / scale)
+            if not np.isfinite(error_norm):
+                error_norm = np.inf # rejected, shrinking the step as far as allowed
+
+            if error_norm <= 1:
+                self.q[:] = q_new
+                k1[:] = k4 # first same as last
+                t += h
+
+            # Only carry the step size over if it wasn't clipped to the interval.
+            if h == self.adaptive_dt or error_norm > 1:
+                factor = 5 if error_norm == 0 else 0.9 * error_norm ** (-1/3)
+                self.adaptive_dt = h * min(5, max(0.2, factor))
+
+            if self.adaptive_dt < ADAPTIVE_MIN_STEP:
+                self.adaptive_dt = self.dt
+                raise FloatingPointError(
+                    f'Adaptive step fell below {ADAPTIVE_MIN_STEP} s, the state is '
+                    'not finite or too stiff.'
+                )
+
+def raw_to_state(q_cart, qd_cart, q_pole, qd_pole, out):
+    # Works on single samples or whole columns, writing into `out` in place.
+    np.multiply(q_cart,  2 / RAIL_TRAVEL, out=out[..., 0])
+    np.multiply(qd_cart, 2 / RAIL_TRAVEL, out=out[..., 1])
+    np.subtract(q_pole, MOUNT_OFFSET, out=out[..., 2])
+    np.multiply(out[..., 2], 2*np.pi/ENCODER_TICKS_PER_REV, out=out[..., 2])
+    np.multiply(qd_pole, 2*np.pi/ENCODER_TICKS_PER_REV, out=out[..., 3])
+
+def encode_command(t):
+    setpoint = struct.pack('<f', t)
+    return COMMAND_FRAME.pack(COMMAND_FRAME_SYNC, setpoint, sum(setpoint) & 0xFF)
+
+class TelemetryDecoder:
+    """
+    Decodes binary state frames from a growing byte buffer. Complete frames
+    are viewed in place as a STATE_FRAME array and converted column-wise
+    straight into the caller's output rows.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.checksum_errors = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def decode(self, out):
+        written = 0
+        start = self.buffer.find(STATE_FRAME_SYNC)
+        size = STATE_FRAME.itemsize
+
+        while start >= 0 and written < len(out):
+            n = min((len(self.buffer) - start) // size, len(out) - written)
+            if n == 0:
+                break
+
+            k = self.decode_frames(start, n, out[written:written + n])
+            written += k
+            start += k*size
+
+            if k < n:
+                # Corrupt frame, resynchronize on the next sync bytes.
+                self.checksum_errors += 1
+                start = self.buffer.find(STATE_FRAME_SYNC, start + 1)
+
+        if start < 0:
+            # Keep a trailing byte in case it is the start of a sync pair.
+            start = max(len(self.buffer) - 1, 0)
+
+        del self.buffer[:start]
+        return written
+
+    def decode_frames(self, start, n, out):
+        # Returns how many leading frames were valid and written to `out`.
+        # The views must not outlive this call, or the buffer can't be resized.
+        size = STATE_FRAME.itemsize
+        with memoryview(self.buffer)[start:start + n*size] as view:
+            frames = np.frombuffer(view, dtype=STATE_FRAME)
+            frame_bytes = np.frombuffer(view, dtype=np.uint8).reshape(n, size)
+            checksums = frame_bytes[:, 2:-2].sum(axis=1, dtype=np.uint16)
+
+            valid = (frames['checksum'] == checksums) & \
+                    (frame_bytes[:, 0] == STATE_FRAME_SYNC[0]) & \
+                    (frame_bytes[:, 1] == STATE_FRAME_SYNC[1])
+            k = n if valid.all() else int(np.argmin(valid))
+
+            good = frames[:k]
+            raw_to_state(
+                good['cart'], good['cart_velocity'],
+                good['pole'], good['pole_velocity'],
+                out=out[:k]
+            )
+            del frames, frame_bytes, good
+
+        return k
+
+class SerialStateReader(threading.Thread):
+    """
+    Reads the firmware's state lines (or binary frames, once a decoder is set)
+    on a background thread into a preallocated ring buffer. The newest sample is published by bumping
+    `count` after its row is written, so readers never take a lock.
+    """
+
+    def __init__(self, ser, capacity=STATE_BUFFER_SIZE):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.ser = ser
+        self.capacity = capacity
+        self.states = np.zeros((capacity, 4))
+        self.times = np.zeros(capacity)
+        self.count = 0
+        self.parse_errors = 0
+        self.partial = None # start of a line cut off by a timeout, None before the first line break
+        self.running = True
+        self.new_sample = threading.Event()
+        self.decoder = None # set to a TelemetryDecoder for binary telemetry
+
+    def run(self):
+        while self.running:
+            try:
+                if self.decoder is None:
+                    self.read_line()
+                else:
+                    self.read_frames()
+            except serial.SerialException:
+                if self.running:
+                    raise
+                return
+
+    def read_line(self):
+        line = self.ser.readline()
+
+        if not line.endswith(b'\n'):
+            # Timed out mid-line, so the rest comes with the next read.
+            if self.partial is not None:
+                self.partial += line
+            return
+
+        if self.partial is None:
+            # The first line may have started before the port was opened.
+            self.partial = b''
+            return
+
+        line, self.partial = self.partial + line, b''
+
+        try:
+            values = [float(s) for s in line.split()]
+            if len(values) != 4:
+                raise ValueError
+        except ValueError:
+            self.parse_errors += 1
+            return
+
+        i = self.count % self.capacity
+        raw_to_state(*values, out=self.states[i])
+        self.times[i] = time.monotonic()
+
+        self.count += 1
+        self.new_sample.set()
+
+    def read_frames(self):
+        self.decoder.feed(self.ser.read(max(1, self.ser.in_waiting)))
+
+        while True:
+            i = self.count % self.capacity
+            n = self.decoder.decode(self.states[i:])
+            if n == 0:
+                return
+
+            self.times[i:i + n] = time.monotonic()
+            self.count += n
+            self.new_sample.set()
+
+    def stop(self):
+        self.running = False
+
+    def latest(self):
+        count = self.count
+        i = (count - 1) % self.capacity
+        return count, self.states[i], time.monotonic() - self.times[i]
+
+    def wait(self, newer_than, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            self.new_sample.clear()
+            if self.count > newer_than:
+                return True
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            self.new_sample.wait(remaining)
+
+    def wait_quiet(self, period):
+        # Returns once no sample has arrived for period seconds.
+        while self.wait(self.count, period):
+            pass
+
+class StepTimer:
+    """
+    Records monotonic timestamps for each step into a fixed-size ring, to
+    find where the time goes in the hardware control loop.
+    """
+
+    STEP_STARTED   = 0
+    COMMAND_SENT   = 1
+    STATE_READ     = 2
+    STEP_RETURNED  = 3
+    SAMPLE_AGE     = 4
+    BACKLOG        = 5 # samples in the reader's ring not yet read when the state is read
+    DROPPED        = 6 # samples that arrived since the last read but were skipped
+    COLUMNS        = (
+        'step_started', 'command_sent', 'state_read',
+        'step_returned', 'sample_age', 'backlog', 'dropped'
+    )
+
+    def __init__(self, capacity=TIMING_BUFFER_SIZE, period=1/HARDWARE_FREQUENCY):
+        self.capacity = capacity
+        self.period = period
+        self.records = np.full((capacity, len(self.COLUMNS)), np.nan)
+        self.row = None # the step being timed, if any
+        self.count = 0
+        self.episode_start = 0
+
+    def begin(self):
+        self.row = self.records[self.count % self.capacity]
+        self.row[:] = np.nan
+        self.row[self.STEP_STARTED] = time.monotonic()
+
+    def mark(self, column, value=None):
+        self.row[column] = time.monotonic() if value is None else value
+
+    def record_read(self, age, unread):
+        # Reads outside a step, such as those in reset, belong to no row.
+        if self.row is None:
+            return
+
+        # Only the newest of the unread samples is returned.
+        self.row[self.STATE_READ] = time.monotonic()
+        self.row[self.SAMPLE_AGE] = age
+        self.row[self.BACKLOG] = unread
+        self.row[self.DROPPED] = max(unread - 1, 0)
+
+    def end(self):
+        self.row[self.STEP_RETURNED] = time.monotonic()
+        self.row = None
+        self.count += 1
+
+    def rows(self, since=0):
+        start = max(since, self.count - self.capacity)
+        indices = np.arange(start, self.count) % self.capacity
+        return self.records[indices]
+
+    def summary(self, since=0):
+        rows = self.rows(since)
+        if len(rows) == 0:
+            return {'steps': 0}
+
+        def percentiles(values):
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                return None
+            p50, p99 = np.percentile(values, [50, 99])
+            return {'p50': float(p50), 'p99': float(p99)}
+
+        ages = rows[:, self.SAMPLE_AGE]
+        started = rows[:, self.STEP_STARTED]
+        returned = rows[:, self.STEP_RETURNED]
+        intervals = np.diff(started)
+
+        return {
+            'steps': len(rows),
+            'step_latency': percentiles(returned - started),
+            'command': percentiles(rows[:, self.COMMAND_SENT] - started),
+            'read_wait': percentiles(
+                rows[:, self.STATE_READ] - np.fmax(rows[:, self.COMMAND_SENT], started)
+            ),
+            'after_read': percentiles(returned - rows[:, self.STATE_READ]),
+            'policy': percentiles(started[1:] - returned[:-1]),
+            'interval': percentiles(intervals),
+            'jitter': percentiles(np.abs(intervals - self.period)),
+            'sample_age': percentiles(ages),
+            'backlog': percentiles(rows[:, self.BACKLOG]),
+            'dropped': int(np.nansum(rows[:, self.DROPPED])),
+            'stale': int(np.count_nonzero(ages > self.period))
+        }
+
+    def end_episode(self, path=None):
+        summary = self.summary(self.episode_start)
+
+        if path is not None:
+            np.savez(
+                path + '.npz', columns=np.array(self.COLUMNS),
+                records=self.rows(self.episode_start)
+            )
+            with open(path + '.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+
+        self.episode_start = self.count
+        return summary
+
+def load_sim_params(path):
+    # Parameter files are written by sysid.py.
+    with open(path) as f:
+        return json.load(f)
+
+class ForceMap:
+    """
+    Measured map from torque commands to cart accelerations, written by
+    calibration.py. Both directions are precomputed into lookup tables over
+    the action range, so applying the map is a single index per step.
+
+    `command(action)` gives the torque command that makes the acceleration
+    linear in the action, with an action of 1 reaching the largest
+    acceleration available in both directions. `force(action)` gives the
+    normalized acceleration that the plain linear command, TORQUE_SCALING
+    times the action, actually produces, for simulating the raw actuator.
+    """
+
+    def __init__(self, commands, accelerations, size=FORCE_LOOKUP_SIZE):
+        order = np.argsort(commands)
+        self.commands = np.asarray(commands, dtype=float)[order]
+        self.accelerations = np.asarray(accelerations, dtype=float)[order]
+        self.size = size
+
+        # A zero command never moves the cart, so the fit goes through the
+        # origin: noise in the deadband would otherwise map zero force to a
+        # nonzero command. Each side is made monotone outward from there.
+        commands = self.commands
+        accelerations = np.where(self.commands < 0, np.minimum(self.accelerations, 0),
+                                 np.maximum(self.accelerations, 0))
+        center = np.searchsorted(commands, 0)
+        if center == len(commands) or commands[center] != 0:
+            commands = np.insert(commands, center, 0.0)
+            accelerations = np.insert(accelerations, center, 0.0)
+        accelerations[center] = 0
+
+        monotone = np.empty_like(accelerations)
+        monotone[center:] = np.maximum.accumulate(accelerations[center:])
+        monotone[center::-1] = np.minimum.accumulate(accelerations[center::-1])
+        self.max_acceleration = min(monotone[-1], -monotone[0])
+
+        # Tilt flat regions like the deadband and saturation away from the
+        # origin, so the inverse exists and picks the smallest command that
+        # reaches each acceleration.
+        accelerations = monotone + 1e-9 * (np.arange(len(monotone)) - center)
+        actions = np.linspace(-1, 1, size)
+
+        self.command_table = np.interp(
+            actions * self.max_acceleration, accelerations, commands
+        )
+
+        self.force_table = np.interp(
+            actions * TORQUE_SCALING, commands, accelerations
+        ) / self.max_acceleration
+
+        if self.command(0) != 0 or self.force(0) != 0:
+            raise ValueError('Force map does not map zero force to a zero command.')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['commands'], data['accelerations'])
+
+    def save(self, path):
+        np.savez(path, commands=self.commands, accelerations=self.accelerations)
+
+    def index(self, action):
+        return int(round((action + 1) * (self.size - 1) / 2))
+
+    def command(self, action):
+        return self.command_table[self.index(action)]
+
+    def force(self, action):
+        return self.force_table[self.index(action)]
+
+class TrajectoryRecorder:
+    """
+    Appends one row per step to memory-mapped .npy column files in
+    `directory`, starting a new chunk of files every `chunk_rows` rows.
+    Flushing full chunks and creating the next ones happens on a background
+    thread, so the control loop only ever writes into mapped memory.
+
+    Rows written by `record_reset` start a new episode and hold the state
+    after the reset, with NaN action and reward.
+    """
+
+    def __init__(self, directory, observation_size, chunk_rows=RECORD_CHUNK_ROWS):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.columns = {
+            'raw_state':   ('<f8', (4,)),
+            'observation': ('<f8', (observation_size,)),
+            'action':      ('<f8', ()),
+            'reward':      ('<f8', ()),
+            'done':        ('|b1', ()),
+            'episode':     ('<i8', ()),
+            'time':        ('<f8', ()),
+            'sample_age':  ('<f8', ())
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {
+            'columns': {name: [dtype, list(shape)] for name, (dtype, shape) in self.columns.items()},
+            'chunk_rows': chunk_rows,
+            'chunks': [],
+            'started': time.time()
+        }
+
+        self.tasks = queue.Queue()
+        self.ready = queue.Queue(maxsize=1)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+        self.chunk_index = 0
+        self.tasks.put(('create', 0))
+        self.chunk = self.ready.get()
+        self.tasks.put(('create', 1))
+
+        self.row = 0
+        self.episode = -1
+
+    def chunk_path(self, index, name):
+        return os.path.join(self.directory, f'{name}_{index:05d}.npy')
+
+    def create_chunk(self, index):
+        return {
+            name: np.lib.format.open_memmap(
+                self.chunk_path(index, name), mode='w+',
+                dtype=dtype, shape=(self.chunk_rows,) + shape
+            )
+            for name, (dtype, shape) in self.columns.items()
+        }
+
+    def run(self):
+        while True:
+            task, *args = self.tasks.get()
+
+            if task == 'create':
+                self.ready.put(self.create_chunk(*args))
+
+            elif task == 'flush':
+                chunk, index, rows = args
+                for column in chunk.values():
+                    column.flush()
+                self.write_meta(index, rows)
+
+            elif task == 'stop':
+                return
+
+    def write_meta(self, index, rows):
+        chunks = self.meta['chunks']
+        if index < len(chunks):
+            chunks[index] = rows
+        else:
+            chunks.append(rows)
+
+        path = os.path.join(self.directory, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(path + '.tmp', path)
+
+    def record(self, raw_state, observation, action, reward, done, sample_age):
+        chunk, row = self.chunk, self.row
+        chunk['raw_state'][row] = raw_state
+        chunk['observation'][row] = observation
+        chunk['action'][row] = action
+        chunk['reward'][row] = reward
+        chunk['done'][row] = done
+        chunk['episode'][row] = self.episode
+        chunk['time'][row] = time.monotonic()
+        chunk['sample_age'][row] = sample_age
+
+        self.row += 1
+        if self.row == self.chunk_rows:
+            self.next_chunk()
+
+    def record_reset(self, raw_state, observation, sample_age=0.0):
+        self.episode += 1
+        self.record(raw_state, observation, np.nan, np.nan, False, sample_age)
+
+    def next_chunk(self):
+        self.tasks.put(('flush', self.chunk, self.chunk_index, self.row))
+
+        self.chunk_index += 1
+        self.chunk = self.ready.get()
+        self.row = 0
+        self.tasks.put(('create', self.chunk_index + 1))
+
+    def checkpoint(self):
+        # Makes the rows so far visible to readers, without waiting for them.
+        self.tasks.put(('flush', self.chunk, self.chunk_index, self.row))
+
+    def close(self):
+        self.checkpoint()
+        self.tasks.put(('stop',))
+        self.worker.join()
+
+        # The chunk created in advance was never used.
+        for name in self.columns:
+            path = self.chunk_path(self.chunk_index + 1, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+class RecordedRun:
+    """
+    Read-only view of a TrajectoryRecorder directory. Columns are opened as
+    memory maps, so only the rows that are actually used get read from disk.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.names = list(self.meta['columns'])
+        self.chunk_lengths = self.meta['chunks']
+        self.offsets = np.concatenate(([0], np.cumsum(self.chunk_lengths)))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def chunks(self, name):
+        for index, rows in enumerate(self.chunk_lengths):
+            path = os.path.join(self.directory, f'{name}_{index:05d}.npy')
+            yield np.load(path, mmap_mode='r')[:rows]
+
+    def read(self, name, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        for index, column in enumerate(self.chunks(name)):
+            lo, hi = self.offsets[index], self.offsets[index + 1]
+            if hi <= start or lo >= stop:
+                continue
+            parts.append(column[max(start - lo, 0):min(stop, hi) - lo])
+
+        if not parts:
+            dtype, shape = self.meta['columns'][name]
+            return np.empty((0,) + tuple(shape), dtype=dtype)
+
+        return np.concatenate(parts)
+
+    def __getitem__(self, name):
+        return self.read(name)
+
+    def episodes(self):
+        # Yields (start, stop) row ranges, one per recorded episode.
+        starts = []
+        for index, column in enumerate(self.chunks('action')):
+            starts.extend(self.offsets[index] + np.flatnonzero(np.isnan(column)))
+
+        for start, stop in zip(starts, starts[1:] + [len(self)]):
+            yield int(start), int(stop)
+
+def open_run(directory):
+    return RecordedRun(directory)
+
 class HillGym(gym.Env):
     def _only_hardware(f):
         def guarded(self, *args, **kwargs):
@@ -45,9 +835,19 @@ class HillCartpole(HillGym):
         cart_mass = CART_MASS,
         pole_mass = POLE_MASS,
         pole_length = POLE_LENGTH,
+        force_scaling = FORCE_SCALING,
+        sim_params = None,
+        force_map = None,
+        linearize_force = True,
         timestep_limit = MAX_TIMESTEPS,
         windup_penalty = 0.1,
         trig_observations=False,
+        integrator='semi_implicit',
+        substeps=None,
+        binary_telemetry=False,
+        instrument=False,
+        instrument_dir=None,
+        record_dir=None,
         simulation=False,
         verbose=False
     ):
@@ -56,6 +856,42 @@ class HillCartpole(HillGym):
         self.timestep_limit = timestep_limit
         self.trig_observations = trig_observations
         self.windup_penalty = windup_penalty # penalty on sqrt of total angular distance
+        self.observation_age = 0.0
+        
+        # Built once, since step clips against the action space every call.
+        self.action_space = gym.spaces.Box(low=-1, high=1, shape=(1,))
+        self.action_low = float(self.action_space.low[0])
+        self.action_high = float(self.action_space.high[0])
+        
+        if self.trig_observations:
+            self.observation_space = gym.spaces.Box(
+                low= np.array([-1, -np.inf,-1, -1, -np.inf]),
+                high=np.array([1,   np.inf, 1,  1,  np.inf])
+            )
+        else:
+            self.observation_space = gym.spaces.Box(
+                low= np.array([-1., -np.inf, -np.inf, -np.inf]),
+                high=np.array([1.,   np.inf,  np.inf,  np.inf])
+            )
+        
+        # With a measured force map, torque commands on hardware are chosen to
+        # make force linear in the action. With linearize_force=False the
+        # simulator instead reproduces the robot's raw nonlinear response.
+        self.force_map = ForceMap.load(force_map) if force_map is not None else None
+        self.linearize_force = linearize_force
+        
+        # Optional recording of every step, e.g. under a job's /out mount.
+        self.recorder = None
+        if record_dir is not None:
+            self.recorder = TrajectoryRecorder(
+                os.path.join(record_dir, time.strftime('run_%Y%m%d_%H%M%S')),
+                self.observation_space.shape[0]
+            )
+        
+        # Optional step timing, summarized and dumped at the end of each episode.
+        self.timer = StepTimer() if instrument else None
+        self.instrument_dir = instrument_dir
+        self.episodes = 0
         
         try:
             if simulation:
@@ -64,8 +900,20 @@ class HillCartpole(HillGym):
             ports = serial.tools.list_ports.grep('arduino')
             port = next(ports)
             
-            self.ser  = serial.Serial(os.path.join('/dev',port.name), timeout=0)
+            self.ser  = serial.Serial(os.path.join('/dev',port.name), timeout=SERIAL_TIMEOUT)
             self.real = True
+            
+            self.reader = SerialStateReader(self.ser)
+            self.binary_telemetry = binary_telemetry
+            if binary_telemetry:
+                self.reader.decoder = TelemetryDecoder()
+                self.ser.write("cb\r".encode())
+            else:
+                self.ser.write("ca\r".encode())
+            
+            self.reader.start()
+            self.last_sample = 0
+            self.raw_state = np.zeros(4)
         except (serial.SerialException, StopIteration) as e:            
             if self.verbose:
                 if isinstance(e, serial.SerialException):
@@ -75,13 +923,27 @@ class HillCartpole(HillGym):
                 print("Running in simulation mode.")
             
             self.real     = False
-            self.q_sim    = np.zeros(4)
-            self.dt_sim   = 1/SIMULATION_FREQUENCY
-            self.u_repeat = int(SIMULATION_FREQUENCY/HARDWARE_FREQUENCY)
+            
+            if sim_params is not None:
+                params = load_sim_params(sim_params)
+                cart_mass = params.get('cart_mass', cart_mass)
+                pole_mass = params.get('pole_mass', pole_mass)
+                pole_length = params.get('pole_length', pole_length)
+                force_scaling = params.get('force_scaling', force_scaling)
+            
+            self.u_repeat = substeps or int(SIMULATION_FREQUENCY/HARDWARE_FREQUENCY)
+            self.dt_sim   = 1/(HARDWARE_FREQUENCY*self.u_repeat)
+            self.sim      = CartpoleSimulator(
+                1, cart_mass, pole_mass, pole_length, self.dt_sim, integrator,
+                force_scaling
+            )
+            self.q_sim    = self.sim.q[0] # view into the simulator state
+            self.raw_state = self.q_sim
             
             self.cart_mass = cart_mass
             self.pole_mass = pole_mass
             self.pole_length = pole_length
+            self.force_scaling = force_scaling
                 
         self.timesteps = 0
     
@@ -152,54 +1014,59 @@ class HillCartpole(HillGym):
         return self.viewer.render(return_rgb_array = mode=='rgb_array')        
         
     def reset(self):
+        if self.timer is not None and self.timer.count > self.timer.episode_start:
+            self.end_timing_episode()
+        
         if self.real:
             self.enable_quadrature_homing()
             self.home()
-            self.ser.reset_input_buffer()
+            # The firmware sends nothing while it homes, so once samples stop,
+            # the next one is from after homing.
+            self.reader.wait_quiet(HOMING_QUIET)
+            self.last_sample = self.reader.count
             self.get_observation() #  blocks until homing is complete
             self.disable_quadrature_homing()
             self.torque_mode()
         
         else:
-            self.q_sim = np.zeros(4)
+            self.sim.reset()
         
         self.timesteps = 0
-        return self.get_observation()
+        obs = self.get_observation()
+        
+        if self.recorder is not None:
+            self.recorder.checkpoint()
+            self.recorder.record_reset(self.raw_state, obs, self.observation_age)
+        
+        return obs
     
-    def __del__(self):
-        if self.real:
+    def close(self):
+        # Stops the cart and the reader thread, and flushes the recording and
+        # the last episode's timing. Safe to call more than once.
+        if self.timer is not None and self.timer.count > self.timer.episode_start:
+            self.end_timing_episode()
+        
+        if self.real and self.ser.is_open:
             self.torque_mode()
             self.command(0)
+            self.reader.stop()
+            self.reader.join() # reads time out after SERIAL_TIMEOUT
+            self.ser.close()
+        
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
         
         if self.viewer is not None:
             self.render(close=True)
+    
+    def __del__(self):
+        self.close()
 
     
     @HillGym._only_simulation
-    def step_forward_dynamics(self, u):
-        x, xdot, theta, thetadot = self.q_sim
-        
-        theta = -1 * theta
-        
-        x_dotdot = (
-            u + self.pole_mass * np.sin(theta) * (
-                self.pole_length * thetadot**2 + GRAVITY * np.cos(theta)
-            )
-        ) / (self.cart_mass + self.pole_mass * np.sin(theta)**2)
-        
-        theta_dotdot = (
-            -u*np.cos(theta) -
-            self.pole_mass * self.pole_length * thetadot**2 * np.cos(theta) * np.sin(theta) - 
-            (self.cart_mass + self.pole_mass) * GRAVITY * np.sin(theta)
-        ) / (self.pole_length * (self.cart_mass + self.pole_mass * np.sin(theta)**2))
-                
-            
-        # Euler integration
-        qdotdot = np.array([x_dotdot, theta_dotdot])
-        qdot_new = self.q_sim[1::2] + qdotdot * self.dt_sim
-        q_new = self.q_sim[::2] + self.dt_sim * qdot_new
-
-        self.q_sim = np.stack((q_new, qdot_new)).T.flatten()
+    def step_forward_dynamics(self, u, substeps=1):
+        self.sim.step(u, substeps)
             
     @HillGym._only_hardware
     def enable_quadrature_homing(self):
@@ -227,48 +1094,92 @@ class HillCartpole(HillGym):
     
     @HillGym._only_hardware
     def command(self, t):
-        self.ser.write((str(t)+'\r').encode())
+        if self.binary_telemetry:
+            self.ser.write(encode_command(t))
+        else:
+            self.ser.write((str(t)+'\r').encode())
     
     @HillGym._only_hardware
-    def read_state(self):
-        old_r = None
-        r = self.ser.readline().decode().strip().split(' ')
-        while len(r) != 4:
-            r = self.ser.readline().decode().strip().split(' ')
+    def read_state(self, fresh=True, out=None):
+        # Only waits if the newest sample has already been returned, so a step
+        # never takes longer than one state update period.
+        if fresh:
+            self.reader.wait(self.last_sample)
         
-        while len(r) == 4:
-            old_r = r
-            r = self.ser.readline().decode().strip().split(' ')
+        previous = self.last_sample
+        self.last_sample, state, self.observation_age = self.reader.latest()
         
-        try:
-            q_cart, qd_cart, q_pole, qd_pole = [float(s) for s in old_r]
-
-            return np.array([
-                2 * q_cart  / RAIL_TRAVEL,
-                2 * qd_cart / RAIL_TRAVEL,
-                2*np.pi*(q_pole - MOUNT_OFFSET)/(ENCODER_TICKS_PER_REV),
-                2*np.pi*qd_pole/ENCODER_TICKS_PER_REV
-            ])
+        if self.timer is not None:
+            self.timer.record_read(self.observation_age, self.last_sample - previous)
         
-        except:
-            return self.read_state()
+        if out is None:
+            return np.copy(state)
+        
+        out[:] = state
+        return out
     
-    def step(self, action):
-        action = np.clip(action, self.action_space.low, self.action_space.high)[0]
+    def step(self, action, out=None):
+        # Pass `out` to have the observation written into it instead of a new
+        # array, which keeps the simulated step free of NumPy allocations.
+        if self.timer is not None:
+            self.timer.begin()
+        
+        action = min(max(float(action[0]), self.action_low), self.action_high)
         if self.real:
-            scaling = TORQUE_SCALING if self.mode == 't' else VELOCITY_SCALING
-            self.command(scaling*action)
+            if self.mode == 't' and self.force_map is not None and self.linearize_force:
+                self.command(self.force_map.command(action))
+            else:
+                scaling = TORQUE_SCALING if self.mode == 't' else VELOCITY_SCALING
+                self.command(scaling*action)
+            
+            if self.timer is not None:
+                self.timer.mark(StepTimer.COMMAND_SENT)
+        elif self.force_map is not None and not self.linearize_force:
+            self.step_forward_dynamics(self.force_map.force(action), self.u_repeat)
         else:
-            for _ in range(self.u_repeat):
-                self.step_forward_dynamics(action)
+            self.step_forward_dynamics(action, self.u_repeat)
         
-        obs, q = self.get_observation(include_raw=True)
-        reward = self.get_reward(q, action)
+        obs = self.get_observation(out=out)
+        reward = self.get_reward(self.raw_state, action)
         done = self.is_done(obs)
         
+        if self.recorder is not None:
+            self.recorder.record(
+                self.raw_state, obs, action, reward, done, self.observation_age
+            )
+        
         self.timesteps += 1
         
-        return obs, reward, done, {}
+        if self.timer is not None:
+            self.timer.end()
+        
+        return obs, reward, done, {'age': self.observation_age}
+    
+    def timing_summary(self, since=0):
+        summary = self.timer.summary(since)
+        
+        if self.real:
+            summary['parse_errors'] = self.reader.parse_errors
+            if self.reader.decoder is not None:
+                summary['checksum_errors'] = self.reader.decoder.checksum_errors
+        
+        return summary
+    
+    def end_timing_episode(self):
+        path = None
+        if self.instrument_dir is not None:
+            os.makedirs(self.instrument_dir, exist_ok=True)
+            path = os.path.join(self.instrument_dir, f'episode_{self.episodes:05d}')
+        
+        start = self.timer.episode_start
+        summary = self.timing_summary(start)
+        self.timer.end_episode(path)
+        self.episodes += 1
+        
+        if self.verbose:
+            print(f'Episode {self.episodes} timing:', json.dumps(summary))
+        
+        return summary
     
     def is_done(self, obs):
         # Kill trial when too passmuch time has passed
@@ -276,60 +1187,32 @@ class HillCartpole(HillGym):
             return True
         
         # Kill trial if position limits are near being reached
-        if np.abs(obs[0]) > 0.9:
+        if abs(obs[0]) > 0.9:
             return True
         
         return False
     
     def get_reward(self, state, action):
-        cos_theta = np.cos(state[2])
-        
-        
-        # Give reward from 0 to 1 for pole position.
-        # Could also penalize x position, but will not for now.
-        reward = 0.5 * (1-cos_theta)
-        
-        # penalty on sqrt of total angular distance, meant to dissuade
-        # helicopter policies.
-        reward -= self.windup_penalty * np.sqrt(np.abs(state[2]))
-                
-        return reward
+        return cartpole_reward(state, self.windup_penalty)
     
-    def get_observation(self, include_raw=False):
+    def get_observation(self, include_raw=False, out=None):
         if self.real:
-            q_raw = self.read_state()
-                    
-        else:
-            q_raw = np.copy(self.q_sim)
+            self.read_state(out=self.raw_state)
+        
+        q_raw = self.raw_state
         
         if self.trig_observations:
-            q_proc = np.array([
-                q_raw[0], q_raw[1], np.cos(q_raw[2]), np.sin(q_raw[2]), q_raw[3]
-            ])
+            q_proc = trig_observation(q_raw, out)
+        elif out is None:
+            q_proc = np.copy(q_raw)
         else:
-            q_proc = q_raw
+            out[:] = q_raw
+            q_proc = out
         
         if include_raw:
-            return q_proc, q_raw
+            return q_proc, np.copy(q_raw)
         
         return q_proc
-    
-    @property
-    def action_space(self):
-        return gym.spaces.Box(low=-1, high=1, shape=(1,))
-
-    @property
-    def observation_space(self):
-        if self.trig_observations:
-            return gym.spaces.Box(
-                low= np.array([-1, -np.inf,-1, -1, -np.inf]),
-                high=np.array([1,   np.inf, 1,  1,  np.inf])
-            )
-            
-        return gym.spaces.Box(
-            low= np.array([-1., -np.inf, -np.inf, -np.inf]),
-            high=np.array([1.,   np.inf,  np.inf,  np.inf])
-        )
 
 
 if __name__ == "__main__":
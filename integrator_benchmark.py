@@ -0,0 +1,64 @@
+import time
+import numpy as np
+
+from env import CartpoleSimulator, HARDWARE_FREQUENCY, INTEGRATORS
+
+# Compares the simulation integrators by how far they drift from a converged
+# reference trajectory against how much wall-clock time they cost per
+# simulated second. The model as written does not conserve a mechanical
+# energy exactly, so the reference solution is used as ground truth instead.
+
+NUM_CARTS          = 64
+SIMULATED_SECONDS  = 4
+SUBSTEPS           = (1, 2, 4, 8, 16)
+REFERENCE_SUBSTEPS = 256
+REPEATS            = 3
+
+def initial_states(rng):
+    q = np.zeros((NUM_CARTS, 4))
+    q[:, 1] = rng.uniform(-0.5, 0.5, NUM_CARTS)
+    q[:, 2] = rng.uniform(-np.pi, np.pi, NUM_CARTS)
+    q[:, 3] = rng.uniform(-5, 5, NUM_CARTS)
+    return q
+
+def rollout(integrator, substeps, q0, actions):
+    sim = CartpoleSimulator(
+        NUM_CARTS, dt=1/(HARDWARE_FREQUENCY*substeps), integrator=integrator
+    )
+    sim.q[:] = q0
+
+    trajectory = np.empty((len(actions), NUM_CARTS, 4))
+    start = time.perf_counter()
+    for i, u in enumerate(actions):
+        sim.step(u, substeps)
+        trajectory[i] = sim.q
+    elapsed = time.perf_counter() - start
+
+    return trajectory, elapsed
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    q0 = initial_states(rng)
+    steps = int(SIMULATED_SECONDS * HARDWARE_FREQUENCY)
+    actions = rng.uniform(-1, 1, (steps, NUM_CARTS))
+
+    reference, _ = rollout('rk4', REFERENCE_SUBSTEPS, q0, actions)
+
+    print(f'{NUM_CARTS} carts, {SIMULATED_SECONDS} simulated seconds, '
+          f'reference is rk4 with {REFERENCE_SUBSTEPS} substeps per step.')
+    print(f'{"integrator":>14} {"substeps":>8} {"ms/sim s":>10} '
+          f'{"theta rms":>10} {"theta max":>10}')
+
+    for integrator in INTEGRATORS:
+        for substeps in (SUBSTEPS if integrator != 'adaptive' else (1,)):
+            elapsed = min(
+                rollout(integrator, substeps, q0, actions)[1]
+                for _ in range(REPEATS)
+            )
+            trajectory, _ = rollout(integrator, substeps, q0, actions)
+            theta_error = np.abs(trajectory[..., 2] - reference[..., 2])
+
+            print(f'{integrator:>14} {substeps if integrator != "adaptive" else "-":>8} '
+                  f'{1000*elapsed/SIMULATED_SECONDS:>10.2f} '
+                  f'{np.sqrt(np.mean(theta_error**2)):>10.2e} '
+                  f'{np.max(theta_error):>10.2e}')
@@ -29,3 +29,5 @@ e.reset()
 
 print('Model learned, saving:')
 model.save('sac_learned_windup_01')
+
+e.close() # flushes any recording and stops the cart
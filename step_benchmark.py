@@ -0,0 +1,114 @@
+import sys, time, tracemalloc
+import numpy as np
+
+from env import HillCartpole, CartpoleSimulator, trig_observation
+
+# Checks that the steady-state simulated step loop makes no NumPy
+# allocations. NumPy reports array data to tracemalloc under its own domain,
+# so the loop must not retain anything there. Temporaries are freed again
+# within a step, so they are caught by running the same code on a large batch,
+# where the traced peak would grow by at least one state column. A single
+# env's arrays are too small to tell apart from the Python objects every step
+# returns, so its step is instead checked for NumPy memory after every bytecode.
+
+STEPS      = 20000
+WARMUP     = 1000
+BATCH_SIZE = 100000
+
+def numpy_bytes(snapshot):
+    domain = tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)
+    return sum(stat.size for stat in snapshot.filter_traces([domain]).statistics('filename'))
+
+def measure(loop, steps):
+    loop(WARMUP)
+
+    start = time.perf_counter()
+    loop(steps)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    current_before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    loop(steps)
+
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    return {
+        'steps/s': steps / elapsed,
+        'numpy bytes retained': numpy_bytes(after) - numpy_bytes(before),
+        'peak bytes over baseline': peak - current_before
+    }
+
+def numpy_peak(step):
+    # The most NumPy memory held at any bytecode of one call of step, over
+    # what was held before it.
+    tracemalloc.start()
+    baseline = numpy_bytes(tracemalloc.take_snapshot())
+    peak = 0
+
+    def trace(frame, event, arg):
+        nonlocal peak
+        frame.f_trace_opcodes = True
+        peak = max(peak, numpy_bytes(tracemalloc.take_snapshot()) - baseline)
+        return trace
+
+    sys.settrace(trace)
+    sys.setprofile(trace) # also after calls into C
+    try:
+        step()
+    finally:
+        sys.settrace(None)
+        sys.setprofile(None)
+        tracemalloc.stop()
+
+    return peak
+
+def env_loop(trig_observations):
+    env = HillCartpole(simulation=True, trig_observations=trig_observations)
+    obs = np.empty(env.observation_space.shape)
+    action = np.zeros(1)
+    env.reset()
+
+    def loop(steps):
+        for i in range(steps):
+            action[0] = np.sin(i / 10)
+            _, _, done, _ = env.step(action, out=obs)
+            if done:
+                env.sim.reset()
+                env.timesteps = 0
+
+    return loop
+
+def batch_loop():
+    sim = CartpoleSimulator(BATCH_SIZE)
+    obs = np.empty((BATCH_SIZE, 5))
+    u = np.zeros(BATCH_SIZE)
+
+    def loop(steps):
+        for _ in range(steps):
+            sim.step(u, 2)
+            trig_observation(sim.q, obs)
+
+    return loop
+
+if __name__ == "__main__":
+    for trig in (False, True):
+        loop = env_loop(trig)
+        result = measure(loop, STEPS)
+        result['numpy peak within a step'] = numpy_peak(lambda: loop(1))
+        print(f'HillCartpole.step, trig_observations={trig}:', result)
+
+        if result['numpy peak within a step'] > 0:
+            raise SystemExit('HillCartpole.step allocated temporary arrays.')
+
+    column_bytes = BATCH_SIZE * 8
+    result = measure(batch_loop(), STEPS // 100)
+    print(f'CartpoleSimulator({BATCH_SIZE}).step, one column is {column_bytes} bytes:',
+          result)
+
+    if result['peak bytes over baseline'] >= column_bytes:
+        raise SystemExit('The batched step allocated temporary arrays.')
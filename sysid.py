@@ -0,0 +1,197 @@
+import argparse, json, os, time
+import numpy as np
+
+from env import (
+    CartpoleSimulator, CART_MASS, POLE_MASS, POLE_LENGTH, FORCE_SCALING,
+    HARDWARE_FREQUENCY, SIMULATION_FREQUENCY, open_run
+)
+
+# Fits the simulation parameters to trajectories recorded on the robot, by
+# replaying every recorded window through the batched simulator for many
+# candidate parameter sets at once and minimizing the multi-step prediction
+# error with the cross-entropy method.
+#
+# A trajectory is an .npz file with `states`, a (T+1, 4) array of raw states
+# as returned by HillCartpole.read_state, and `actions`, a (T,) array of the
+# actions applied between them, one per hardware step. A run directory written
+# by HillCartpole(record_dir=...) can be given instead, and each of its
+# episodes is used as a trajectory.
+#
+#     python3 sysid.py sim_params.json trial_*.npz
+#
+# The result loads with HillCartpole(simulation=True, sim_params=...).
+#
+# Scaling both masses and the force scaling by the same factor gives exactly
+# the same motion, so the cart mass is held fixed and the rest are fitted
+# relative to it.
+
+PARAMETERS     = ('cart_mass', 'pole_mass', 'pole_length', 'force_scaling')
+INITIAL_GUESS  = (CART_MASS, POLE_MASS, POLE_LENGTH, FORCE_SCALING)
+FITTED         = (False, True, True, True)
+
+HORIZON        = 25     # steps predicted from each window start
+STRIDE         = 10     # steps between window starts
+MAX_CARTS      = 1 << 17 # carts simulated per batch
+
+def load_trajectories(paths):
+    trajectories = []
+    for path in paths:
+        if os.path.isdir(path):
+            trajectories += load_run(path)
+            continue
+
+        with np.load(path) as data:
+            trajectories.append(
+                (np.asarray(data['states'], dtype=float),
+                 np.asarray(data['actions'], dtype=float).reshape(-1))
+            )
+
+    return trajectories
+
+def load_run(path):
+    run = open_run(path)
+    trajectories = []
+    for start, stop in run.episodes():
+        # The first row of an episode is the reset, which has no action.
+        trajectories.append(
+            (run.read('raw_state', start, stop), run.read('action', start + 1, stop))
+        )
+
+    return trajectories
+
+def make_windows(trajectories, horizon=HORIZON, stride=STRIDE):
+    starts, actions, targets = [], [], []
+    for states, traj_actions in trajectories:
+        for t in range(0, len(traj_actions) - horizon + 1, stride):
+            starts.append(states[t])
+            actions.append(traj_actions[t:t + horizon])
+            targets.append(states[t + 1:t + horizon + 1])
+
+    if not starts:
+        raise ValueError(f'No trajectory is longer than the {horizon} step horizon.')
+
+    return np.array(starts), np.array(actions), np.array(targets)
+
+class PredictionError:
+    """
+    Scores candidate parameter sets by their mean squared multi-step prediction
+    error over all windows, with each state dimension normalized by its spread
+    in the recorded data.
+    """
+
+    def __init__(self, windows, substeps=None, integrator='semi_implicit'):
+        self.starts, self.actions, self.targets = windows
+        self.num_windows, self.horizon = self.actions.shape
+        self.substeps = substeps or int(SIMULATION_FREQUENCY/HARDWARE_FREQUENCY)
+        self.dt = 1/(HARDWARE_FREQUENCY*self.substeps)
+        self.integrator = integrator
+        self.scale = 1 / np.maximum(self.targets.reshape(-1, 4).std(axis=0), 1e-6)
+
+    def __call__(self, candidates):
+        # candidates is (P, len(PARAMETERS)), returns (P,) errors.
+        errors = np.empty(len(candidates))
+        per_batch = max(1, MAX_CARTS // self.num_windows)
+
+        for start in range(0, len(candidates), per_batch):
+            batch = candidates[start:start + per_batch]
+            errors[start:start + len(batch)] = self.evaluate(batch)
+
+        return errors
+
+    def evaluate(self, candidates):
+        count = len(candidates)
+        params = np.repeat(candidates, self.num_windows, axis=0)
+
+        sim = CartpoleSimulator(
+            count * self.num_windows, *params.T[:3], dt=self.dt,
+            integrator=self.integrator, force_scaling=params[:, 3]
+        )
+        sim.q[:] = np.tile(self.starts, (count, 1))
+
+        # Viewed per candidate, so the targets broadcast instead of being tiled.
+        q = sim.q.reshape(count, self.num_windows, 4)
+        diff = np.empty_like(q)
+        actions = np.tile(self.actions, (count, 1))
+        squared_error = np.zeros((count, self.num_windows))
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            for h in range(self.horizon):
+                sim.step(actions[:, h], self.substeps)
+
+                np.subtract(q, self.targets[:, h], out=diff)
+                diff *= self.scale
+                np.square(diff, out=diff)
+                squared_error += diff.sum(axis=2)
+
+        squared_error[~np.isfinite(squared_error)] = np.inf
+        return squared_error.mean(axis=1)
+
+def fit(
+    objective,
+    initial=INITIAL_GUESS,
+    fitted=FITTED,
+    population=2048,
+    elite_fraction=0.1,
+    iterations=30,
+    initial_spread=0.5,
+    seed=0,
+    verbose=False
+):
+    # Cross-entropy method over log-parameters, which keeps them positive.
+    # Parameters that aren't fitted keep their initial value.
+    rng = np.random.RandomState(seed)
+    fitted = np.array(fitted)
+    mean = np.log(initial)
+    std = np.where(fitted, initial_spread, 0.0)
+    num_elite = max(2, int(population * elite_fraction))
+
+    best, best_error = np.array(initial, dtype=float), objective(np.array([initial]))[0]
+
+    for i in range(iterations):
+        samples = mean + std * rng.randn(population, len(initial))
+        candidates = np.exp(samples)
+
+        start = time.perf_counter()
+        errors = objective(candidates)
+        elapsed = time.perf_counter() - start
+
+        elite = np.argsort(errors)[:num_elite]
+        mean = samples[elite].mean(axis=0)
+        std = np.where(fitted, samples[elite].std(axis=0) + 1e-3, 0.0)
+
+        if errors[elite[0]] < best_error:
+            best, best_error = candidates[elite[0]], errors[elite[0]]
+
+        if verbose:
+            print(f'Iteration {i}: error {best_error:.5f}, '
+                  f'{population/elapsed:.0f} candidates/s')
+
+    return dict(zip(PARAMETERS, best.tolist())), best_error
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit simulation parameters to recorded trajectories.')
+    parser.add_argument('output', help='parameter file to write')
+    parser.add_argument('trajectories', nargs='+', help='recorded .npz trajectories or run directories')
+    parser.add_argument('--cart-mass', type=float, default=CART_MASS,
+                        help='fixed cart mass the other parameters are relative to')
+    parser.add_argument('--horizon', type=int, default=HORIZON)
+    parser.add_argument('--stride', type=int, default=STRIDE)
+    parser.add_argument('--population', type=int, default=2048)
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+
+    windows = make_windows(load_trajectories(args.trajectories), args.horizon, args.stride)
+    print(f'Fitting to {len(windows[0])} windows of {args.horizon} steps.')
+
+    params, error = fit(
+        PredictionError(windows),
+        initial=(args.cart_mass,) + INITIAL_GUESS[1:],
+        population=args.population,
+        iterations=args.iterations,
+        verbose=True
+    )
+
+    with open(args.output, 'w') as f:
+        json.dump(params, f, indent=2)
+
+    print(f'Wrote {params} with error {error:.5f} to {args.output}.')
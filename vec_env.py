@@ -0,0 +1,395 @@
+import multiprocessing as mp
+import numpy as np
+from stable_baselines.common.vec_env import VecEnv
+
+from env import (
+    HillCartpole, CartpoleSimulator, cartpole_reward, trig_observation,
+    CART_MASS, POLE_MASS, POLE_LENGTH, FORCE_SCALING, MAX_TIMESTEPS,
+    HARDWARE_FREQUENCY, SIMULATION_FREQUENCY
+)
+
+RANDOMIZABLE_PARAMETERS = ('cart_mass', 'pole_mass', 'pole_length', 'force_scaling')
+
+# Attributes with one entry per env, on the vec env or its simulator. Any
+# other attribute is a setting shared by all envs.
+PER_ENV_ATTRIBUTES = RANDOMIZABLE_PARAMETERS + ('q', 'timesteps', 'actions')
+
+class HillCartpoleVecEnv(VecEnv):
+    """
+    Simulated HillCartpole environments stepped together in a single
+    CartpoleSimulator. Environments are reset automatically when they are
+    done, with the final observation stored in info['terminal_observation'].
+
+    `randomize` maps any of RANDOMIZABLE_PARAMETERS to a (low, high) range
+    that is resampled uniformly for each environment every time it resets.
+
+    get_attr and set_attr work on single environments for the attributes in
+    PER_ENV_ATTRIBUTES. env_method can reset single environments, and calls
+    any other method on all of them at once.
+    """
+
+    def __init__(
+        self,
+        num_envs,
+        cart_mass = CART_MASS,
+        pole_mass = POLE_MASS,
+        pole_length = POLE_LENGTH,
+        force_scaling = FORCE_SCALING,
+        timestep_limit = MAX_TIMESTEPS,
+        windup_penalty = 0.1,
+        trig_observations=False,
+        integrator='semi_implicit',
+        substeps=None,
+        randomize=None,
+        seed=None
+    ):
+        spaces = HillCartpole(
+            simulation=True, trig_observations=trig_observations
+        )
+        VecEnv.__init__(
+            self, num_envs, spaces.observation_space, spaces.action_space
+        )
+
+        self.timestep_limit = timestep_limit
+        self.windup_penalty = windup_penalty
+        self.trig_observations = trig_observations
+        self.randomize = dict(randomize or {})
+
+        for name in self.randomize:
+            if name not in RANDOMIZABLE_PARAMETERS:
+                raise ValueError(f'Cannot randomize parameter "{name}".')
+
+        self.u_repeat = substeps or int(SIMULATION_FREQUENCY/HARDWARE_FREQUENCY)
+        self.sim = CartpoleSimulator(
+            num_envs, cart_mass, pole_mass, pole_length,
+            1/(HARDWARE_FREQUENCY*self.u_repeat), integrator, force_scaling
+        )
+        self.timesteps = np.zeros(num_envs, dtype=int)
+        self.actions = np.zeros(num_envs)
+        self.rng = np.random.RandomState(seed)
+
+    def seed(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        return [seed] * self.num_envs
+
+    def reset_envs(self, mask):
+        self.sim.reset(mask)
+        self.timesteps[mask] = 0
+
+        count = np.count_nonzero(mask)
+        for name, (low, high) in self.randomize.items():
+            getattr(self.sim, name)[mask] = self.rng.uniform(low, high, count)
+
+    def reset(self):
+        self.reset_envs(np.ones(self.num_envs, dtype=bool))
+        return self.get_observations()
+
+    def get_observations(self):
+        if self.trig_observations:
+            return trig_observation(self.sim.q)
+
+        return np.copy(self.sim.q)
+
+    def step_async(self, actions):
+        actions = np.reshape(actions, (self.num_envs, -1))[:, 0]
+        self.actions = np.clip(
+            actions, self.action_space.low[0], self.action_space.high[0]
+        )
+
+    def step_wait(self):
+        self.sim.step(self.actions, self.u_repeat)
+
+        obs = self.get_observations()
+        rewards = cartpole_reward(self.sim.q, self.windup_penalty)
+        dones = (self.timesteps >= self.timestep_limit) | (np.abs(obs[:, 0]) > 0.9)
+        infos = [{} for _ in range(self.num_envs)]
+
+        self.timesteps += 1
+
+        if dones.any():
+            for i in np.flatnonzero(dones):
+                infos[i]['terminal_observation'] = np.copy(obs[i])
+
+            self.reset_envs(dones)
+            obs[dones] = self.get_observations()[dones]
+
+        return obs, rewards, dones, infos
+
+    def close(self):
+        pass
+
+    def get_attr(self, attr_name, indices=None):
+        indices = self._indices(indices)
+        if attr_name in PER_ENV_ATTRIBUTES:
+            values = getattr(self._owner(attr_name), attr_name)
+            return [values[i].copy() for i in indices]
+
+        return [getattr(self, attr_name)] * len(indices)
+
+    def set_attr(self, attr_name, value, indices=None):
+        indices = self._indices(indices)
+        if attr_name in PER_ENV_ATTRIBUTES:
+            getattr(self._owner(attr_name), attr_name)[list(indices)] = value
+            return
+
+        require_all_envs(attr_name, indices, self.num_envs)
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        indices = self._indices(indices)
+        if method_name == 'reset':
+            mask = np.zeros(self.num_envs, dtype=bool)
+            mask[list(indices)] = True
+            self.reset_envs(mask)
+            obs = self.get_observations()
+            return [obs[i] for i in indices]
+
+        # Other methods act on state shared by all envs, such as the seed.
+        require_all_envs(method_name, indices, self.num_envs)
+        result = getattr(self, method_name)(*method_args, **method_kwargs)
+        if isinstance(result, (list, np.ndarray)) and len(result) == self.num_envs:
+            return [result[i] for i in indices]
+
+        return [result] * len(indices)
+
+    def _owner(self, attr_name):
+        return self if hasattr(self, attr_name) else self.sim
+
+    def _indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+
+        if isinstance(indices, int):
+            return [indices]
+
+        return indices
+
+def require_all_envs(name, indices, num_envs):
+    if sorted(indices) != list(range(num_envs)):
+        raise ValueError(f'"{name}" is shared by all envs, so it cannot be used on some of them.')
+
+def run_worker(remote, parent_remote, start, stop, buffers, seed, env_kwargs):
+    parent_remote.close()
+
+    obs, actions, rewards, dones, terminal = shared_arrays(buffers)
+    env = HillCartpoleVecEnv(stop - start, seed=seed, **env_kwargs)
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+
+            if cmd == 'step':
+                env.step_async(actions[start:stop])
+                o, r, d, infos = env.step_wait()
+
+                obs[start:stop] = o
+                rewards[start:stop] = r
+                dones[start:stop] = d
+                for i in np.flatnonzero(d):
+                    terminal[start + i] = infos[i]['terminal_observation']
+
+                remote.send(None)
+
+            elif cmd == 'reset':
+                obs[start:stop] = env.reset()
+                remote.send(None)
+
+            elif cmd == 'seed':
+                remote.send(env.seed(data))
+
+            elif cmd == 'get_attr':
+                remote.send(env.get_attr(*data))
+
+            elif cmd == 'set_attr':
+                env.set_attr(*data)
+                remote.send([None] * len(data[-1]))
+
+            elif cmd == 'env_method':
+                name, args, kwargs, indices = data
+                remote.send(env.env_method(name, *args, indices=indices, **kwargs))
+
+            elif cmd == 'close':
+                break
+
+            else:
+                raise NotImplementedError(f'Unknown command "{cmd}".')
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        remote.close()
+
+def shared_arrays(buffers):
+    obs, actions, rewards, dones, terminal, num_envs, obs_dim = buffers
+    return (
+        np.frombuffer(obs, dtype=np.float64).reshape(num_envs, obs_dim),
+        np.frombuffer(actions, dtype=np.float64),
+        np.frombuffer(rewards, dtype=np.float64),
+        np.frombuffer(dones, dtype=np.uint8).view(bool),
+        np.frombuffer(terminal, dtype=np.float64).reshape(num_envs, obs_dim)
+    )
+
+class SubprocHillCartpoleVecEnv(VecEnv):
+    """
+    Splits the environments across worker processes, each stepping its share
+    with a HillCartpoleVecEnv. Observations, actions, rewards and dones are
+    exchanged through shared memory, so only short commands are pickled.
+
+    Worker i is seeded with seed + i. Any other keyword arguments are passed
+    on to HillCartpoleVecEnv.
+    """
+
+    def __init__(self, num_envs, num_workers=None, seed=None, start_method=None, **env_kwargs):
+        spaces = HillCartpole(
+            simulation=True,
+            trig_observations=env_kwargs.get('trig_observations', False)
+        )
+        VecEnv.__init__(
+            self, num_envs, spaces.observation_space, spaces.action_space
+        )
+
+        num_workers = min(num_workers or mp.cpu_count(), num_envs)
+        obs_dim = spaces.observation_space.shape[0]
+
+        if start_method is None:
+            # Forking a process that has already started TensorFlow is unsafe.
+            methods = mp.get_all_start_methods()
+            start_method = 'forkserver' if 'forkserver' in methods else 'spawn'
+        ctx = mp.get_context(start_method)
+
+        self.buffers = (
+            ctx.RawArray('d', num_envs * obs_dim),
+            ctx.RawArray('d', num_envs),
+            ctx.RawArray('d', num_envs),
+            ctx.RawArray('B', num_envs),
+            ctx.RawArray('d', num_envs * obs_dim),
+            num_envs, obs_dim
+        )
+        self.obs, self.actions, self.rewards, self.dones, self.terminal = \
+            shared_arrays(self.buffers)
+
+        self.bounds = bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self.remotes, self.processes = [], []
+        for i in range(num_workers):
+            remote, work_remote = ctx.Pipe()
+            worker_seed = None if seed is None else seed + i
+            process = ctx.Process(
+                target=run_worker,
+                args=(
+                    work_remote, remote, bounds[i], bounds[i + 1],
+                    self.buffers, worker_seed, env_kwargs
+                ),
+                daemon=True
+            )
+            process.start()
+            work_remote.close()
+
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+        self.closed = False
+
+    def broadcast(self, cmd, data=None):
+        for remote in self.remotes:
+            remote.send((cmd, data))
+
+        return [remote.recv() for remote in self.remotes]
+
+    def seed(self, seed=None):
+        seeds = []
+        for i, remote in enumerate(self.remotes):
+            remote.send(('seed', None if seed is None else seed + i))
+        for remote in self.remotes:
+            seeds += remote.recv()
+
+        return seeds
+
+    def reset(self):
+        self.broadcast('reset')
+        return np.copy(self.obs)
+
+    def step_async(self, actions):
+        self.actions[:] = np.reshape(actions, (self.num_envs, -1))[:, 0]
+        for remote in self.remotes:
+            remote.send(('step', None))
+
+    def step_wait(self):
+        for remote in self.remotes:
+            remote.recv()
+
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(self.dones):
+            infos[i]['terminal_observation'] = np.copy(self.terminal[i])
+
+        return np.copy(self.obs), np.copy(self.rewards), np.copy(self.dones), infos
+
+    def close(self):
+        if self.closed:
+            return
+
+        for remote in self.remotes:
+            try:
+                remote.send(('close', None))
+            except (BrokenPipeError, EOFError):
+                pass
+
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        for remote in self.remotes:
+            remote.close()
+
+        self.closed = True
+
+    def call_envs(self, cmd, indices, *data):
+        # Sends cmd to each worker with some of the envs in indices, passing
+        # them on as the worker's own indices, and puts the results back in
+        # the order of indices.
+        indices = list(self._indices(indices))
+        workers = np.searchsorted(self.bounds, indices, side='right') - 1
+
+        selected = {}
+        for worker, index in zip(workers, indices):
+            selected.setdefault(worker, []).append(int(index - self.bounds[worker]))
+
+        for worker, local in selected.items():
+            self.remotes[worker].send((cmd, data + (local,)))
+        results = {worker: iter(self.remotes[worker].recv()) for worker in selected}
+
+        return [next(results[worker]) for worker in workers]
+
+    def get_attr(self, attr_name, indices=None):
+        # Workers each know only their share of the envs.
+        if attr_name == 'num_envs':
+            return [self.num_envs] * len(self._indices(indices))
+
+        return self.call_envs('get_attr', indices, attr_name)
+
+    def set_attr(self, attr_name, value, indices=None):
+        if attr_name not in PER_ENV_ATTRIBUTES:
+            require_all_envs(attr_name, self._indices(indices), self.num_envs)
+
+        self.call_envs('set_attr', indices, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        if method_name != 'reset':
+            require_all_envs(method_name, self._indices(indices), self.num_envs)
+
+        # Worker i is seeded with seed + i, as seed() does.
+        if method_name == 'seed':
+            seeds = self.seed(*method_args, **method_kwargs)
+            return [seeds[i] for i in self._indices(indices)]
+
+        return self.call_envs('env_method', indices, method_name, method_args, method_kwargs)
+
+    def _indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+
+        if isinstance(indices, int):
+            return [indices]
+
+        return indices
@@ -1,13 +1,95 @@
-from datetime import datetime, timedelta
-from fastapi import FastAPI, File, UploadFile
+import aiofiles
+import asyncio
+from datetime import datetime, timedelta, timezone
+import fcntl
+from fastapi import (
+    Depends, FastAPI, File, Header, HTTPException, Request, Response, UploadFile
+)
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import (
+    HTMLResponse, FileResponse, JSONResponse, StreamingResponse
+)
 from fastapi.staticfiles import StaticFiles
+import hashlib
+import json
 import os
+import re
 from pydantic import BaseModel
-from typing import List
+import sqlalchemy
+import time
+from typing import List, Optional
+import uuid
+
+from cache import ResponseCache
+from db import activity, blobs, database, events, jobs, robots, IS_SQLITE, STATUS
+from events import Broadcaster, Notifier
+
+# Each worker writes a robot's heartbeat at most this often.
+HEARTBEAT_INTERVAL = 30
+COMPACTION_BATCH = 10000
+COMPACTION_PAUSE = 0.1
+# Longest a pop or job wait may be held open, and how often a waiting
+# request checks the database anyway, in case a notification was missed.
+MAX_WAIT = 60
+WAIT_RECHECK = 5
+NOTIFY_FILE = 'job_events'
+LOG_NOTIFY_FILE = 'log_events'
+STATUS_NOTIFY_FILE = 'status_events'
+EVENT_NOTIFY_FILE = 'dashboard_events'
+# Each worker reads new events in batches this big, and checks for them
+# this often when it hasn't been notified.
+EVENT_BATCH = 500
+EVENT_RECHECK = 5
+# Events older than this are deleted, every EVENT_PRUNE_INTERVAL seconds.
+EVENT_RETENTION = 3600
+EVENT_PRUNE_INTERVAL = 60
+# Streams send a comment this often, so idle connections stay open.
+EVENT_KEEPALIVE = 15
+# Largest single log append, and how often a follower checks whether the job
+# ended when no new output has arrived.
+MAX_LOG_APPEND = 4 << 20
+LOG_FOLLOW_RECHECK = 5
+# Uploads are streamed to disk, and downloads from disk, in chunks this big.
+CHUNK_SIZE = 1 << 20
+MAX_CODE_ZIP_SIZE = 100 << 20
+MAX_OUTPUT_ZIP_SIZE = 4 << 30
+# Allowance for the other form fields, such as the job logs.
+MAX_FORM_OVERHEAD = 16 << 20
+# Jobs per page of a queue or history.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Longest a cached queue or history, or list of active robots, is served.
+# Job lists are dropped sooner whenever a job changes.
+JOBS_CACHE_TTL = 30
+ACTIVITY_CACHE_TTL = 5
+
+HEARTBEAT = (
+    'INSERT INTO robots (robot, last_seen) VALUES (:robot, CURRENT_TIMESTAMP) '
+    'ON CONFLICT (robot) DO UPDATE SET last_seen = excluded.last_seen'
+)
 
-from db import activity, database, jobs, STATUS
+ADD_BLOB_REFERENCE = (
+    'INSERT INTO blobs (hash, size, refcount) VALUES (:hash, :size, 1) '
+    'ON CONFLICT (hash) DO UPDATE SET refcount = blobs.refcount + 1'
+)
+
+FOLD_ACTIVITY = (
+    'INSERT INTO robots (robot, last_seen) '
+    'SELECT robot, max(timestamp) FROM activity WHERE id <= :last GROUP BY robot '
+    'ON CONFLICT (robot) DO UPDATE SET last_seen = excluded.last_seen '
+    'WHERE excluded.last_seen > robots.last_seen'
+)
+
+last_heartbeats = {}
+compaction = None
+publisher = None
+notifier = Notifier(NOTIFY_FILE)
+log_notifier = Notifier(LOG_NOTIFY_FILE)
+status_notifier = Notifier(STATUS_NOTIFY_FILE)
+event_notifier = Notifier(EVENT_NOTIFY_FILE)
+response_cache = ResponseCache()
+broadcaster = Broadcaster()
 
 app = FastAPI()
 
@@ -16,12 +98,99 @@ app.add_middleware(
     allow_origins=['*'],
     allow_credentials=True,
     allow_methods=['*'],
-    allow_headers=['*']
+    allow_headers=['*'],
+    expose_headers=['X-Log-Size', 'X-Next-Cursor']
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+@app.middleware('http')
+async def limit_upload_size(request: Request, call_next):
+    # Turn away uploads that are too big before their body is read at all.
+    # Chunked uploads without a length are checked as they are saved.
+    if request.url.path.startswith('/job/') and request.method in ('POST', 'PUT'):
+        limit = MAX_CODE_ZIP_SIZE if request.method == 'POST' else MAX_OUTPUT_ZIP_SIZE
+        length = request.headers.get('content-length')
+
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                return JSONResponse({'detail': 'Invalid Content-Length.'}, status_code=400)
+
+            if length > limit + MAX_FORM_OVERHEAD:
+                return JSONResponse({'detail': 'Upload too large.'}, status_code=413)
+
+    return await call_next(request)
+
+
+def cache_rule(path):
+    # The robot a cacheable GET lists jobs of, or None for all robots, and
+    # how long its response may be kept.
+    parts = path.strip('/').split('/')
+    if parts[0] in ('queue', 'history') and len(parts) <= 2:
+        return (parts[1] if len(parts) == 2 else None), JOBS_CACHE_TTL
+    if path == '/activity/':
+        return None, ACTIVITY_CACHE_TTL
+    return None
+
+
+def cache_generation(robot):
+    # Job changes in this worker bump the generation of the job's robot and
+    # of the lists of all robots. Changes in other workers are only seen
+    # through the notifier files, as a change to every robot.
+    return (response_cache.generation(robot),
+            notifier.version_all,
+            status_notifier.version_all)
+
+
+async def add_event(kind, job_id=None, robot=None):
+    # Call after the change is written, so no cached response made from the
+    # old rows can carry the new generation.
+    if job_id is not None:
+        response_cache.invalidate(robot, None)
+
+    query = events.insert(None).values(kind=kind, job_id=job_id, robot=robot)
+    await database.execute(query)
+    event_notifier.notify('events')
+
+
+@app.middleware('http')
+async def cache_responses(request: Request, call_next):
+    # Dashboards poll the same lists every few seconds, so those are served
+    # from memory until a job changes, and as a bare 304 when the client
+    # already has the same body.
+    rule = cache_rule(request.url.path) if request.method == 'GET' else None
+    if rule is None:
+        return await call_next(request)
+
+    robot, ttl = rule
+    key = f'{request.url.path}?{request.url.query}'
+    generation = cache_generation(robot)
+    entry = response_cache.get(key, generation)
+
+    if entry is None:
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+
+        body = b''.join([chunk async for chunk in response.body_iterator])
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() not in ('content-length', 'etag')}
+        entry = response_cache.put(key, generation, ttl, body, headers)
+
+    headers = dict(entry.headers, etag=entry.etag)
+    headers['cache-control'] = 'no-cache'
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None and entry.matches(if_none_match):
+        return Response(status_code=304, headers={'etag': entry.etag,
+                                                  'cache-control': 'no-cache'})
+
+    return Response(entry.body, headers=headers)
+
+
 class Job(BaseModel):
     id: int
     timestamp: datetime
@@ -31,21 +200,248 @@ class Job(BaseModel):
     mount: str
     robot: str
     logs: str
+    owner: Optional[str] = None
+    claimed_at: Optional[datetime] = None
+    code_hash: Optional[str] = None
+    updated_at: Optional[datetime] = None
+
+
+class JobSummary(BaseModel):
+    # A job as listed in queues and histories, with only the fields asked for.
+    id: int
+    timestamp: datetime
+    status: Optional[str] = None
+    container: Optional[str] = None
+    run_command: Optional[str] = None
+    mount: Optional[str] = None
+    robot: Optional[str] = None
+    logs: Optional[str] = None
+    owner: Optional[str] = None
+    claimed_at: Optional[datetime] = None
+    code_hash: Optional[str] = None
+    updated_at: Optional[datetime] = None
+
+
+class Blob(BaseModel):
+    hash: str
+    size: int
+    refcount: int
 
 
 def ensure_storage():
-    for storage_folder in ['code_zips', 'output_zips']:
+    for storage_folder in ['code_zips', 'code_blobs', 'output_zips', 'job_logs']:
         if not os.path.exists(storage_folder):
             os.makedirs(storage_folder)
 
 
+async def receive_upload(upload, folder, max_size):
+    # Streams the upload into a temporary file in folder and returns its
+    # path and SHA-256, so the caller can move it into place once it is
+    # complete.
+    ensure_storage()
+    path = os.path.join(folder, f'{uuid.uuid4().hex}.part')
+    size = 0
+    digest = hashlib.sha256()
+
+    try:
+        async with aiofiles.open(path, 'wb') as f:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail='Upload too large.')
+
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path, digest.hexdigest()
+
+
+def log_path(job_id):
+    return f'job_logs/{job_id}.log'
+
+
+def log_size(job_id):
+    try:
+        return os.path.getsize(log_path(job_id))
+    except FileNotFoundError:
+        return 0
+
+
+def blob_path(code_hash):
+    return f'code_blobs/{code_hash}.zip'
+
+
+def code_path(job):
+    if job['code_hash'] is not None:
+        return blob_path(job['code_hash'])
+
+    return f'code_zips/{job["id"]}.zip'
+
+
+async def read_file_range(path, start, length):
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+
+            length -= len(chunk)
+            yield chunk
+
+
+def file_response(request, path, filename):
+    # Serves path, or the single byte range the request asks for, so that
+    # interrupted downloads of large zips can resume.
+    size = os.path.getsize(path)
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', request.headers.get('range', ''))
+
+    if match is None or match.groups() == ('', ''):
+        return FileResponse(path, filename=filename,
+                            headers={'Accept-Ranges': 'bytes'})
+
+    first, last = match.groups()
+    if first == '':
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last != '' else size - 1
+
+    if start >= size or start > end:
+        return JSONResponse({'detail': 'Range not satisfiable.'},
+                            status_code=416,
+                            headers={'Content-Range': f'bytes */{size}'})
+
+    return StreamingResponse(
+        read_file_range(path, start, end - start + 1),
+        status_code=206,
+        media_type='application/zip',
+        headers={
+            'Accept-Ranges': 'bytes',
+            'Content-Range': f'bytes {start}-{end}/{size}',
+            'Content-Length': str(end - start + 1),
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        }
+    )
+
+
+async def heartbeat(robot_name):
+    now = time.monotonic()
+    if now - last_heartbeats.get(robot_name, -HEARTBEAT_INTERVAL) < HEARTBEAT_INTERVAL:
+        return
+
+    await database.execute(HEARTBEAT, {'robot': robot_name})
+    last_heartbeats[robot_name] = now
+    await add_event('heartbeat', robot=robot_name)
+
+
+async def compact_activity():
+    # Folds the old append-only activity log into robots and deletes it, a
+    # batch at a time so that pops are never held up for long.
+    while True:
+        query = sqlalchemy.select([activity.c.id]) \
+                          .order_by(activity.c.id.asc()) \
+                          .limit(COMPACTION_BATCH)
+        rows = await database.fetch_all(query)
+
+        if not rows:
+            return
+
+        last = rows[-1]['id']
+        async with database.transaction():
+            await database.execute(FOLD_ACTIVITY, {'last': last})
+            await database.execute(activity.delete().where(activity.c.id <= last))
+
+        await asyncio.sleep(COMPACTION_PAUSE)
+
+
+async def event_messages(rows):
+    # Server-sent event messages for rows of events, each with the job as it
+    # is now, or null if it has been deleted since.
+    job_ids = {row['job_id'] for row in rows if row['job_id'] is not None}
+    columns = [column for column in jobs.c if column.name != 'logs']
+    query = sqlalchemy.select(columns).where(jobs.c.id.in_(job_ids))
+    current = {job['id']: job for job in await database.fetch_all(query)} if job_ids else {}
+
+    messages = []
+    for row in rows:
+        job = current.get(row['job_id'])
+        data = {'kind': row['kind'],
+                'timestamp': row['timestamp'],
+                'job_id': row['job_id'],
+                'robot': row['robot'],
+                'job': JobSummary(**dict(job)) if job is not None else None}
+        messages.append(
+            (row['id'], f'id: {row["id"]}\ndata: {json.dumps(jsonable_encoder(data))}\n\n')
+        )
+
+    return messages
+
+
+async def latest_event_id():
+    return await database.fetch_val(sqlalchemy.select([sqlalchemy.func.max(events.c.id)])) or 0
+
+
+async def publish_events():
+    # Reads new events once per worker and hands them to every stream the
+    # worker has open, so the database sees one query per batch of events
+    # however many dashboards are connected.
+    loop = asyncio.get_event_loop()
+    last = await latest_event_id()
+    pruned = loop.time()
+
+    while True:
+        version = event_notifier.version('events')
+        try:
+            query = events.select().where(events.c.id > last) \
+                                   .order_by(events.c.id.asc()) \
+                                   .limit(EVENT_BATCH)
+            rows = await database.fetch_all(query)
+
+            if rows:
+                for message in await event_messages(rows):
+                    broadcaster.publish(message)
+                last = rows[-1]['id']
+                continue
+
+            if loop.time() - pruned > EVENT_PRUNE_INTERVAL:
+                old_time = datetime.utcnow() - timedelta(seconds=EVENT_RETENTION)
+                await database.execute(events.delete().where(events.c.timestamp < old_time))
+                pruned = loop.time()
+        except Exception as e:
+            print(f'Could not publish events ({e}).')
+
+        await event_notifier.wait('events', EVENT_RECHECK, version)
+
+
 @app.on_event('startup')
 async def startup():
+    global compaction, publisher
+
     await database.connect()
+    compaction = asyncio.create_task(compact_activity())
+    publisher = asyncio.create_task(publish_events())
+    notifier.start()
+    log_notifier.start()
+    status_notifier.start()
+    event_notifier.start()
 
 
 @app.on_event('shutdown')
 async def shutdown():
+    compaction.cancel()
+    publisher.cancel()
+    notifier.stop()
+    log_notifier.stop()
+    status_notifier.stop()
+    event_notifier.stop()
     await database.disconnect()
 
 
@@ -54,38 +450,128 @@ async def main():
     return '\n'.join(open('index.html').readlines())
 
 
-@app.get('/queue/', response_model=List[Job])
-async def read_all_queues():
-    query = jobs.select().where(jobs.c.status == STATUS['QUEUED']) \
-                         .order_by(jobs.c.timestamp.asc())
+class JobPage:
+    """
+    Which page of a queue or history to list. Pages are ordered by timestamp
+    and id, and the next one starts after the cursor sent back in the
+    X-Next-Cursor header. With since, only jobs whose status changed at or
+    after that time are listed. Logs are left out unless include_logs is set,
+    and fields picks the columns read, of which id and timestamp always are.
+    """
+
+    def __init__(self,
+                 limit: int = DEFAULT_PAGE_SIZE,
+                 cursor: Optional[str] = None,
+                 since: Optional[datetime] = None,
+                 fields: Optional[str] = None,
+                 include_logs: bool = False):
+        self.limit = max(1, min(limit, MAX_PAGE_SIZE))
+        self.cursor = cursor
+        self.since = since
+        self.fields = fields
+        self.include_logs = include_logs
+
+    def columns(self):
+        if self.fields is None:
+            names = [name for name in jobs.c.keys() if name != 'logs']
+        else:
+            names = [name.strip() for name in self.fields.split(',') if name.strip()]
+            unknown = [name for name in names if name not in jobs.c]
+            if unknown:
+                raise HTTPException(status_code=400,
+                                    detail=f'Unknown fields: {", ".join(unknown)}.')
+
+        if self.include_logs and 'logs' not in names:
+            names.append('logs')
+
+        return [jobs.c.id, jobs.c.timestamp] + \
+               [jobs.c[name] for name in names if name not in ('id', 'timestamp')]
+
+    def after_cursor(self, ascending):
+        try:
+            timestamp, job_id = self.cursor.rsplit(',', 1)
+            timestamp, job_id = datetime.fromisoformat(timestamp), int(job_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor.')
+
+        key = sqlalchemy.tuple_(jobs.c.timestamp, jobs.c.id)
+        start = sqlalchemy.tuple_(stored_timestamp(timestamp), job_id)
+        return key > start if ascending else key < start
+
+
+def stored_timestamp(value):
+    # SQLite keeps timestamps as text, so they are compared in the format
+    # CURRENT_TIMESTAMP writes rather than the one SQLAlchemy binds.
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    if not IS_SQLITE:
+        return sqlalchemy.literal(value, sqlalchemy.DateTime)
+    return sqlalchemy.literal(value.isoformat(sep=' '), sqlalchemy.String)
+
+
+async def read_jobs(response, page, condition, ascending):
+    query = sqlalchemy.select(page.columns()).where(condition)
+
+    if page.cursor is not None:
+        query = query.where(page.after_cursor(ascending))
+    if page.since is not None:
+        query = query.where(jobs.c.updated_at >= stored_timestamp(page.since))
+
+    if ascending:
+        query = query.order_by(jobs.c.timestamp.asc(), jobs.c.id.asc())
+    else:
+        query = query.order_by(jobs.c.timestamp.desc(), jobs.c.id.desc())
+
+    rows = await database.fetch_all(query.limit(page.limit))
+
+    if len(rows) == page.limit:
+        last = rows[-1]
+        response.headers['X-Next-Cursor'] = f'{last["timestamp"].isoformat(sep=" ")},{last["id"]}'
+
+    return rows
 
-    return await database.fetch_all(query)
 
+@app.get('/queue/', response_model=List[JobSummary], response_model_exclude_unset=True)
+async def read_all_queues(response: Response, page: JobPage = Depends()):
+    condition = jobs.c.status == STATUS['QUEUED']
 
-@app.get('/queue/{robot_name}', response_model=List[Job])
-async def read_robot_queue(robot_name: str):
-    query = jobs.select().where(jobs.c.status == STATUS['QUEUED']) \
-                         .where(jobs.c.robot == robot_name) \
-                         .order_by(jobs.c.timestamp.asc())
+    return await read_jobs(response, page, condition, ascending=True)
 
-    return await database.fetch_all(query)
 
+@app.get('/queue/{robot_name}', response_model=List[JobSummary],
+         response_model_exclude_unset=True)
+async def read_robot_queue(robot_name: str, response: Response, page: JobPage = Depends()):
+    condition = sqlalchemy.and_(jobs.c.status == STATUS['QUEUED'],
+                                jobs.c.robot == robot_name)
 
-@app.get('/history/', response_model=List[Job])
-async def read_all_histories():
-    query = jobs.select().where(jobs.c.status != STATUS['QUEUED']) \
-                         .order_by(jobs.c.timestamp.desc())
+    return await read_jobs(response, page, condition, ascending=True)
 
-    return await database.fetch_all(query)
 
+@app.get('/history/', response_model=List[JobSummary], response_model_exclude_unset=True)
+async def read_all_histories(response: Response, page: JobPage = Depends()):
+    condition = jobs.c.status != STATUS['QUEUED']
 
-@app.get('/history/{robot_name}', response_model=List[Job])
-async def read_robot_history(robot_name: str):
-    query = jobs.select().where(jobs.c.status != STATUS['QUEUED']) \
-                         .where(jobs.c.robot == robot_name) \
-                         .order_by(jobs.c.timestamp.desc())
+    return await read_jobs(response, page, condition, ascending=False)
 
-    return await database.fetch_all(query)
+
+@app.get('/history/{robot_name}', response_model=List[JobSummary],
+         response_model_exclude_unset=True)
+async def read_robot_history(robot_name: str, response: Response, page: JobPage = Depends()):
+    condition = sqlalchemy.and_(jobs.c.status != STATUS['QUEUED'],
+                                jobs.c.robot == robot_name)
+
+    return await read_jobs(response, page, condition, ascending=False)
+
+
+@app.get('/blob/{code_hash}', response_model=Blob)
+async def read_blob(code_hash: str):
+    query = blobs.select().where(blobs.c.hash == code_hash)
+    blob = await database.fetch_one(query)
+
+    if blob is None or not os.path.exists(blob_path(code_hash)):
+        raise HTTPException(status_code=404, detail='Unknown code hash.')
+
+    return blob
 
 
 @app.post('/job/', response_model=Job)
@@ -93,18 +579,57 @@ async def create_job(container: str,
                      mount: str,
                      robot: str,
                      run_command: str,
-                     code_zip: UploadFile = File(...)):
-    query = jobs.insert(None).values(container=container,
-                                     mount=mount,
-                                     robot=robot,
-                                     run_command=run_command)
-
-    last_job_id = await database.execute(query)
-
-    ensure_storage()
-    with open(f'code_zips/{last_job_id}.zip', 'wb+') as f:
-        output = await code_zip.read()
-        f.write(output)
+                     code_hash: str = None,
+                     code_zip: UploadFile = File(None)):
+    # The zip can be left out if the server already has one with code_hash.
+    upload = None
+    if code_zip is not None:
+        upload, upload_hash = await receive_upload(code_zip, 'code_blobs',
+                                                   MAX_CODE_ZIP_SIZE)
+        if code_hash is not None and code_hash != upload_hash:
+            os.remove(upload)
+            raise HTTPException(status_code=400, detail='Code hash does not match.')
+        code_hash = upload_hash
+    elif code_hash is None:
+        raise HTTPException(status_code=400, detail='Send code_zip or code_hash.')
+
+    # Blob files are only added and removed while holding the write lock
+    # that updating the refcount takes, so a concurrent delete can't remove
+    # a blob that this job is about to use.
+    try:
+        async with database.transaction():
+            if upload is not None:
+                size = os.path.getsize(upload)
+                await database.execute(ADD_BLOB_REFERENCE,
+                                       {'hash': code_hash, 'size': size})
+                if os.path.exists(blob_path(code_hash)):
+                    os.remove(upload)
+                else:
+                    os.replace(upload, blob_path(code_hash))
+                upload = None
+            else:
+                query = blobs.update().where(blobs.c.hash == code_hash) \
+                                      .values(refcount=blobs.c.refcount + 1)
+                await database.execute(query)
+
+                query = blobs.select().where(blobs.c.hash == code_hash)
+                if await database.fetch_one(query) is None or \
+                   not os.path.exists(blob_path(code_hash)):
+                    raise HTTPException(status_code=404, detail='Unknown code hash.')
+
+            query = jobs.insert(None).values(container=container,
+                                             mount=mount,
+                                             robot=robot,
+                                             run_command=run_command,
+                                             code_hash=code_hash,
+                                             updated_at=sqlalchemy.func.now())
+            last_job_id = await database.execute(query)
+    finally:
+        if upload is not None:
+            os.remove(upload)
+
+    notifier.notify(robot)
+    await add_event('created', last_job_id, robot)
 
     new_query = jobs.select().where(jobs.c.id == last_job_id)
 
@@ -121,34 +646,210 @@ async def read_job(job_id: int):
 @app.put('/job/{job_id}', response_model=Job)
 async def update_job(job_id: int,
                      job_status: str,
-                     job_logs: UploadFile = File(...),
+                     job_logs: UploadFile = File(None),
                      output_zip: UploadFile = File(...)):
-    job_logs_string = await job_logs.read()
-    query = jobs.update().values(status=job_status, logs=job_logs_string) \
+    job = await database.fetch_one(jobs.select().where(jobs.c.id == job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail='Unknown job.')
+
+    upload, _ = await receive_upload(output_zip, 'output_zips', MAX_OUTPUT_ZIP_SIZE)
+    os.replace(upload, f'output_zips/{job_id}.zip')
+
+    # Daemons that don't stream their logs send them all here instead.
+    if job_logs is not None:
+        upload, _ = await receive_upload(job_logs, 'job_logs', MAX_OUTPUT_ZIP_SIZE)
+        if os.path.getsize(upload) > 0:
+            os.replace(upload, log_path(job_id))
+        else:
+            os.remove(upload)
+
+    query = jobs.update().values(status=job_status,
+                                 updated_at=sqlalchemy.func.now()) \
                          .where(jobs.c.id == job_id)
     await database.execute(query)
+    log_notifier.notify(job_id)
+    status_notifier.notify(job_id)
+
+    new_query = jobs.select(jobs.c.id == job_id)
+    job = await database.fetch_one(new_query)
+
+    # Deleted while the results were uploading.
+    if job is None:
+        for path in [f'output_zips/{job_id}.zip', log_path(job_id)]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise HTTPException(status_code=404, detail='Unknown job.')
+
+    await add_event(job['status'], job_id, job['robot'])
+    return job
+
+
+@app.post('/job/{job_id}/logs')
+async def append_logs(job_id: int, offset: int, request: Request):
+    # Appends the body to the job's log, as long as offset is no further on
+    # than the log's current size. Anything before the end of the log has
+    # been received already, so a retried append is not written twice.
+    data = await request.body()
+    if len(data) > MAX_LOG_APPEND:
+        raise HTTPException(status_code=413, detail='Log append too large.')
+
+    job = await database.fetch_one(jobs.select().where(jobs.c.id == job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail='Unknown job.')
 
     ensure_storage()
-    with open(f'output_zips/{job_id}.zip', 'wb+') as f:
-        output = await output_zip.read()
-        f.write(output)
+    loop = asyncio.get_event_loop()
+    size, data = await loop.run_in_executor(None, write_log, job_id, offset, data)
+    if data is None:
+        return JSONResponse({'size': size}, status_code=409)
+
+    log_notifier.notify(job_id)
+    return {'size': size + len(data)}
+
+
+def write_log(job_id, offset, data):
+    # Runs on a thread, since waiting for another append's lock would hold
+    # up the event loop. Returns the log's size before the append, and the
+    # part of data written, or None if offset is past the end of the log.
+    with open(log_path(job_id), 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            return size, None
+
+        data = data[size - offset:]
+        f.write(data)
+
+    return size, data
+
+
+@app.post('/job/{job_id}/cancel', response_model=Job)
+async def cancel_job(job_id: int):
+    # Only jobs that haven't ended can be cancelled. A running job is stopped
+    # by its robot, which is waiting on the job's status.
+    query = jobs.update().where(jobs.c.id == job_id) \
+                         .where(jobs.c.status.in_([STATUS['QUEUED'], STATUS['RUNNING']])) \
+                         .values(status=STATUS['CANCELLED'],
+                                 updated_at=sqlalchemy.func.now())
+    await database.execute(query)
+    status_notifier.notify(job_id)
 
-    new_query = jobs.select(jobs.c.id == job_id)
+    job = await database.fetch_one(jobs.select().where(jobs.c.id == job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail='Unknown job.')
+
+    if job['status'] == STATUS['CANCELLED']:
+        await add_event('cancelled', job_id, job['robot'])
+
+    return job
+
+
+@app.get('/job/{job_id}/wait', response_model=Job)
+async def wait_for_job(job_id: int, status: str, timeout: float = 0):
+    # Returns the job as soon as its status is no longer `status`, or as it
+    # is once timeout seconds have passed.
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + min(timeout, MAX_WAIT)
+
+    while True:
+        version = status_notifier.version(job_id)
+        job = await database.fetch_one(jobs.select().where(jobs.c.id == job_id))
+        if job is None:
+            raise HTTPException(status_code=404, detail='Unknown job.')
+
+        remaining = deadline - loop.time()
+        if job['status'] != status or remaining <= 0:
+            return job
+
+        await status_notifier.wait(job_id, min(remaining, WAIT_RECHECK), version)
 
-    return await database.fetch_one(new_query)
+
+@app.get('/job/{job_id}/logs')
+async def read_logs(job_id: int, offset: int = 0, follow: bool = False):
+    job = await database.fetch_one(jobs.select().where(jobs.c.id == job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail='Unknown job.')
+
+    # Jobs from before logs were streamed keep them in the database.
+    if not os.path.exists(log_path(job_id)) and job['logs']:
+        logs = job['logs'].encode()
+        return Response(logs[offset:], media_type='text/plain',
+                        headers={'X-Log-Size': str(len(logs))})
+
+    if follow:
+        return StreamingResponse(follow_logs(job_id, offset), media_type='text/plain')
+
+    # Nothing has been logged yet.
+    if not os.path.exists(log_path(job_id)):
+        return Response(b'', media_type='text/plain', headers={'X-Log-Size': '0'})
+
+    size = log_size(job_id)
+    return StreamingResponse(read_file_range(log_path(job_id), offset, size - offset),
+                             media_type='text/plain',
+                             headers={'X-Log-Size': str(size)})
+
+
+async def follow_logs(job_id, offset):
+    # Sends the log as it grows, until the job is no longer queued or running.
+    while True:
+        version = log_notifier.version(job_id)
+        size = log_size(job_id)
+
+        if size > offset:
+            async for chunk in read_file_range(log_path(job_id), offset, size - offset):
+                yield chunk
+            offset = size
+            continue
+
+        query = sqlalchemy.select([jobs.c.status]).where(jobs.c.id == job_id)
+        job = await database.fetch_one(query)
+        if job is None or job['status'] not in (STATUS['QUEUED'], STATUS['RUNNING']):
+            if log_size(job_id) <= offset:
+                return
+            continue
+
+        await log_notifier.wait(job_id, LOG_FOLLOW_RECHECK, version)
+
+
+async def remove_unused_blob(code_hash):
+    query = blobs.select().where(blobs.c.hash == code_hash)
+    blob = await database.fetch_one(query)
+
+    if blob is not None and blob['refcount'] <= 0:
+        await database.execute(blobs.delete().where(blobs.c.hash == code_hash))
+        if os.path.exists(blob_path(code_hash)):
+            os.remove(blob_path(code_hash))
 
 
 @app.delete('/job/{job_id}', response_model=Job)
 async def delete_job(job_id: int):
-    query = jobs.select(jobs.c.id == job_id)
-    job = await database.fetch_one(query)
+    async with database.transaction():
+        # Dropping the job's blob reference first takes the write lock before
+        # anything is read, and does nothing if the job is already gone.
+        code_hash = sqlalchemy.select([jobs.c.code_hash]) \
+                              .where(jobs.c.id == job_id) \
+                              .as_scalar()
+        query = blobs.update().where(blobs.c.hash == code_hash) \
+                              .values(refcount=blobs.c.refcount - 1)
+        await database.execute(query)
+
+        query = jobs.select(jobs.c.id == job_id)
+        job = await database.fetch_one(query)
+
+        new_query = jobs.delete().where(jobs.c.id == job_id)
+        await database.execute(new_query)
 
-    new_query = jobs.delete().where(jobs.c.id == job_id)
-    await database.execute(new_query)
+        if job is not None and job['code_hash'] is not None:
+            await remove_unused_blob(job['code_hash'])
+
+    status_notifier.notify(job_id)
+    if job is not None:
+        await add_event('deleted', job_id, job['robot'])
 
     for path in [
         f'code_zips/{job_id}.zip',
-        f'output_zips/{job_id}.zip'
+        f'output_zips/{job_id}.zip',
+        log_path(job_id)
     ]:
         if os.path.exists(path):
             os.remove(path)
@@ -157,20 +858,20 @@ async def delete_job(job_id: int):
 
 
 @app.get('/code/{job_id}')
-async def read_code(job_id: int):
+async def read_code(job_id: int, request: Request):
     query = jobs.select(jobs.c.id == job_id)
     job = await database.fetch_one(query)
 
-    path = f'code_zips/{job_id}.zip'
-
-    if job is None or not os.path.exists(path):
+    if job is None or not os.path.exists(code_path(job)):
         return None
 
-    return FileResponse(path, filename=f'{job_id}.zip')
+    path = code_path(job)
+
+    return file_response(request, path, f'{job_id}.zip')
 
 
 @app.get('/output/{job_id}')
-async def read_output(job_id: int):
+async def read_output(job_id: int, request: Request):
     query = jobs.select(jobs.c.id == job_id)
     job = await database.fetch_one(query)
 
@@ -179,40 +880,136 @@ async def read_output(job_id: int):
     if job is None or not os.path.exists(path):
         return None
 
-    return FileResponse(path, filename=f'{job_id}.zip')
-
-
-@app.post('/pop/{robot_name}', response_model=Job)
-async def pop(robot_name: str):
-    # Record this activity.
-    query = activity.insert(None).values(robot=robot_name)
-
-    await database.execute(query)
-
-    # Pop the robot from the queue.
-    query = jobs.select().where(jobs.c.status == STATUS['QUEUED']) \
-                         .where(jobs.c.robot == robot_name) \
-                         .order_by(jobs.c.timestamp.asc())
-
-    job = await database.fetch_one(query)
-
-    if job is None:
-        return None
-
-    query = jobs.update().values(status=STATUS['RUNNING']) \
-                         .where(jobs.c.id == job.id)
-    await database.execute(query)
-
-    return await database.fetch_one(jobs.select(jobs.c.id == job.id))
+    return file_response(request, path, f'{job_id}.zip')
+
+
+async def claim_job(robot_name, owner):
+    # Claim the oldest queued job in a single statement, so two workers can
+    # never both move the same job to running. On server databases, a job
+    # another claim has locked is skipped rather than waited for. A retried pop with the same
+    # owner token claims nothing new and gets back the job it already has.
+    other = jobs.alias('other')
+    oldest = sqlalchemy.select([other.c.id]) \
+                       .where(other.c.status == STATUS['QUEUED']) \
+                       .where(other.c.robot == robot_name) \
+                       .order_by(other.c.timestamp.asc(), other.c.id.asc()) \
+                       .limit(1) \
+                       .with_for_update(skip_locked=True) \
+                       .as_scalar()
+    claimed = sqlalchemy.exists().where(other.c.owner == owner)
+
+    query = jobs.update().where(jobs.c.id == oldest) \
+                         .where(jobs.c.status == STATUS['QUEUED']) \
+                         .where(~claimed) \
+                         .values(status=STATUS['RUNNING'],
+                                 owner=owner,
+                                 claimed_at=sqlalchemy.func.now(),
+                                 updated_at=sqlalchemy.func.now())
+
+    # Reading the job back in the same transaction keeps the write lock, so
+    # the read never waits behind another worker's claim.
+    async with database.transaction():
+        await database.execute(query)
+
+        query = jobs.select().where(jobs.c.owner == owner)
+        return await database.fetch_one(query)
+
+
+@app.post('/pop/{robot_name}', response_model=Optional[Job])
+async def pop(robot_name: str, owner: str = None, wait: float = 0):
+    await heartbeat(robot_name)
+
+    if owner is None:
+        owner = uuid.uuid4().hex
+
+    # With wait, hold the request open until a job is created for this robot.
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + min(wait, MAX_WAIT)
+
+    while True:
+        version = notifier.version(robot_name)
+        job = await claim_job(robot_name, owner)
+
+        if job is not None:
+            status_notifier.notify(job['id'])
+            await add_event('popped', job['id'], robot_name)
+            return job
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+
+        await notifier.wait(robot_name, min(remaining, WAIT_RECHECK), version)
+
+
+@app.get('/events/')
+async def read_events(last_event_id: Optional[int] = Header(None)):
+    # Streams every change to jobs and robots as server-sent events. A
+    # stream starts with a reset, after which the client should load the
+    # lists afresh. Reconnecting with Last-Event-ID resumes where the last
+    # stream left off, if that event is still kept.
+    return StreamingResponse(stream_events(last_event_id),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache',
+                                      'X-Accel-Buffering': 'no'})
+
+
+async def stream_events(last_event_id):
+    queue = broadcaster.subscribe()
+    try:
+        yield 'retry: 1000\n\n'
+
+        # Subscribing first means nothing published from here on is missed,
+        # and anything also replayed is skipped by its id.
+        query = events.select().where(events.c.id == last_event_id)
+        if last_event_id is not None and await database.fetch_one(query) is not None:
+            after = last_event_id
+            while True:
+                query = events.select().where(events.c.id > after) \
+                                       .order_by(events.c.id.asc()) \
+                                       .limit(EVENT_BATCH)
+                rows = await database.fetch_all(query)
+                if not rows:
+                    break
+
+                for _, message in await event_messages(rows):
+                    yield message
+                after = rows[-1]['id']
+        else:
+            after = await latest_event_id()
+            yield reset_message(after)
+
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+
+            if message is None:
+                # Fell behind, so start over.
+                queue = broadcaster.subscribe()
+                after = await latest_event_id()
+                yield reset_message(after)
+                continue
+
+            event_id, text = message
+            if event_id > after:
+                after = event_id
+                yield text
+    finally:
+        broadcaster.unsubscribe(queue)
+
+
+def reset_message(event_id):
+    return f'id: {event_id}\ndata: {json.dumps({"kind": "reset"})}\n\n'
 
 
 @app.get('/activity/', response_model=List[str])
 async def read_active_robots(seconds_since_last_ping: int = 180):
     old_time = datetime.utcnow() - timedelta(seconds=seconds_since_last_ping)
-    query = activity.select() \
-                    .where(activity.c.timestamp > old_time) \
-                    .column(activity.c.robot) \
-                    .distinct()
+    query = sqlalchemy.select([robots.c.robot]) \
+                      .where(robots.c.last_seen > old_time)
 
     robot_rows = await database.fetch_all(query)
     return [row.robot for row in robot_rows]
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import hashlib
+import time
+
+
+class CachedResponse:
+    def __init__(self, body, headers, generation, expires):
+        self.body = body
+        self.headers = headers
+        self.generation = generation
+        self.expires = expires
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+    def matches(self, if_none_match):
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return self.etag in tags or 'W/' + self.etag in tags or '*' in tags
+
+
+class ResponseCache:
+    """
+    Keeps recent response bodies in memory, for requests that many clients
+    repeat, such as dashboards polling the queues. An entry is used only
+    while the generation it was made in is still current and it is younger
+    than its time to live, so a write that bumps the generation is seen by
+    the next request.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = {}
+
+    def generation(self, key):
+        return self.generations.get(key, 0)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def get(self, request_key, generation):
+        entry = self.entries.get(request_key)
+        if entry is None:
+            return None
+
+        if entry.generation != generation or entry.expires < time.monotonic():
+            del self.entries[request_key]
+            return None
+
+        self.entries.move_to_end(request_key)
+        return entry
+
+    def put(self, request_key, generation, ttl, body, headers):
+        # Take the generation before reading what body is made from, so a
+        # write in between leaves the entry already out of date.
+        entry = CachedResponse(body, headers, generation, time.monotonic() + ttl)
+        self.entries[request_key] = entry
+        self.entries.move_to_end(request_key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return entry
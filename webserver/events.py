@@ -0,0 +1,129 @@
+import asyncio
+import os
+
+
+class Notifier:
+    """
+    Lets requests wait until something happens to a key, such as a robot
+    getting a new job. Workers in other processes are woken through a
+    shared file, which each notification appends a byte to and each worker
+    polls. The size tells notifications apart even when they land in the
+    same tick of a coarse modification time.
+    """
+
+    def __init__(self, path=None, poll_interval=0.05, max_size=1 << 20):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_size = max_size
+        self.waiters = {}
+        self.versions = {}
+        self.version_all = 0
+        self.signature = None
+        self.watcher = None
+
+    def version(self, key):
+        # Take this before checking for work, and pass it to wait, so that
+        # a notification in between is not missed.
+        return self.versions.get(key, 0), self.version_all
+
+    async def wait(self, key, timeout, since=None):
+        if since is not None and since != self.version(key):
+            return True
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(key, set()).add(future)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self.waiters.get(key)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self.waiters[key]
+
+    def wake(self, key=None):
+        # Wakes the waiters on key, or all of them if key is None.
+        if key is None:
+            self.version_all += 1
+            keys = list(self.waiters)
+        else:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            keys = [key]
+
+        for key in keys:
+            for future in self.waiters.get(key, ()):
+                if not future.done():
+                    future.set_result(None)
+
+    def notify(self, key):
+        self.wake(key)
+
+        if self.path is not None:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, b'.')
+                # Truncated in place rather than replaced, so that a byte
+                # appended by another worker meanwhile can't go to a file
+                # nobody watches.
+                if os.fstat(fd).st_size >= self.max_size:
+                    os.ftruncate(fd, 0)
+            finally:
+                os.close(fd)
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+
+            signature = self.file_signature()
+            if signature != self.signature:
+                self.signature = signature
+                self.wake()
+
+    def start(self):
+        if self.path is not None:
+            self.signature = self.file_signature()
+            self.watcher = asyncio.ensure_future(self.watch())
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+
+
+class Broadcaster:
+    """
+    Hands every published message to the queue of each subscriber. A
+    subscriber that falls too far behind is dropped and sent None, after
+    which it has to start over.
+    """
+
+    def __init__(self, max_queued=1000):
+        self.max_queued = max_queued
+        self.subscribers = set()
+
+    def subscribe(self):
+        queue = asyncio.Queue(self.max_queued)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, message):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
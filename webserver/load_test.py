@@ -0,0 +1,200 @@
+import argparse
+from collections import defaultdict
+import hashlib
+import io
+import multiprocessing as mp
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+
+import requests
+
+# Starts the server under gunicorn against each database in turn, runs
+# clients making a mix of pops, job creates, result uploads and history reads
+# against it, and reports requests per second for each.
+#
+#     cd webserver && python3 load_test.py
+#     python3 load_test.py --database sqlite --database postgresql://hill@localhost/hill_load
+#
+# `sqlite` is a new file in a temporary directory, run once per journal mode
+# in --journal-modes. Server databases should start empty, and the jobs the
+# test creates are left in them.
+
+WORKERS = 4
+PROCESSES = 4
+THREADS = 8
+ROBOTS = 16
+DURATION = 20
+PORT = 8799
+JOURNAL_MODES = 'WAL,DELETE'
+
+# Relative frequency of each kind of request.
+MIX = {'pop': 3, 'create': 2, 'finish': 2, 'history': 3}
+
+
+def make_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as f:
+        f.writestr('main.py', 'print("hello")\n')
+    return buffer.getvalue()
+
+
+def start_server(url, database, journal_mode, workers, port):
+    # The server keeps its files in the current directory, so it runs in a
+    # temporary one that only links to the dashboard.
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp()
+    for name in ('static', 'index.html'):
+        os.symlink(os.path.join(here, name), os.path.join(directory, name))
+
+    if database == 'sqlite':
+        database = f'sqlite:///{directory}/hill.db'
+
+    env = dict(os.environ, HILL_DATABASE_URL=database)
+    if journal_mode is not None:
+        env['HILL_SQLITE_JOURNAL_MODE'] = journal_mode
+
+    server = subprocess.Popen(
+        ['gunicorn', '-w', str(workers), '-k', 'uvicorn.workers.UvicornWorker',
+         '-b', f'127.0.0.1:{port}', '--pythonpath', here, '--chdir', directory,
+         'api:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    for _ in range(100):
+        try:
+            requests.get(url + '/activity/', timeout=1).raise_for_status()
+            return server
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+
+    server.kill()
+    raise SystemExit(f'The server did not start for {database}.')
+
+
+def client(url, robots, deadline, code_zip, results):
+    session = requests.Session()
+    code_hash = hashlib.sha256(code_zip).hexdigest()
+    popped = []
+    kinds, weights = zip(*MIX.items())
+
+    while time.perf_counter() < deadline:
+        kind = random.choices(kinds, weights)[0]
+        if kind == 'finish' and not popped:
+            kind = 'pop'
+        robot = random.choice(robots)
+
+        start = time.perf_counter()
+        try:
+            if kind == 'pop':
+                r = session.post(f'{url}/pop/{robot}')
+                if r.ok and r.json() is not None:
+                    popped.append(r.json()['id'])
+            elif kind == 'create':
+                params = {'container': 'load', 'mount': '/output', 'robot': robot,
+                          'run_command': 'true', 'code_hash': code_hash}
+                r = session.post(f'{url}/job/', params=params)
+                if r.status_code == 404:
+                    r = session.post(f'{url}/job/', params=params,
+                                     files={'code_zip': code_zip})
+            elif kind == 'finish':
+                r = session.put(f'{url}/job/{popped.pop()}',
+                                params={'job_status': 'finished'},
+                                files={'output_zip': code_zip})
+            else:
+                r = session.get(f'{url}/history/{robot}')
+            ok = r.ok
+        except requests.exceptions.RequestException:
+            ok = False
+
+        results[kind].append((time.perf_counter() - start, ok))
+
+
+def client_process(url, robots, deadline, threads, queue):
+    results = defaultdict(list)
+    code_zip = make_zip()
+    workers = [
+        threading.Thread(target=client, args=(url, robots, deadline, code_zip, results))
+        for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    queue.put(dict(results))
+
+
+def run(database, journal_mode, args):
+    url = f'http://127.0.0.1:{args.port}'
+    server = start_server(url, database, journal_mode, args.workers, args.port)
+
+    try:
+        robots = [f'robot{i}' for i in range(args.robots)]
+        deadline = time.perf_counter() + args.duration
+        queue = mp.Queue()
+        processes = [
+            mp.Process(target=client_process,
+                       args=(url, robots, deadline, args.threads, queue))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+
+        results = defaultdict(list)
+        for _ in processes:
+            for kind, samples in queue.get().items():
+                results[kind] += samples
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    return results
+
+
+def report(name, results, duration):
+    total = sum(len(samples) for samples in results.values())
+    print(f'{name}: {total / duration:.0f} requests/s')
+
+    for kind in MIX:
+        samples = results.get(kind, [])
+        if not samples:
+            continue
+
+        times = sorted(1000 * elapsed for elapsed, _ in samples)
+        errors = sum(not ok for _, ok in samples)
+        print(f'  {kind:>8}: {len(samples) / duration:7.0f}/s   '
+              f'p50 {statistics.median(times):6.1f} ms   '
+              f'p99 {times[int(0.99 * (len(times) - 1))]:6.1f} ms   '
+              f'{errors} errors')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the server on each database.')
+    parser.add_argument('--database', action='append',
+                        help='database URL, or sqlite for a temporary file (repeatable)')
+    parser.add_argument('--journal-modes', default=JOURNAL_MODES,
+                        help='SQLite journal modes to compare')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--processes', type=int, default=PROCESSES)
+    parser.add_argument('--threads', type=int, default=THREADS)
+    parser.add_argument('--robots', type=int, default=ROBOTS)
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    for database in args.database or ['sqlite']:
+        if database.startswith('sqlite'):
+            runs = [(f'{database} ({mode})', mode) for mode in args.journal_modes.split(',')]
+        else:
+            runs = [(database, None)]
+
+        for name, journal_mode in runs:
+            report(name, run(database, journal_mode, args), args.duration)
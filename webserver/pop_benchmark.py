@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+from collections import Counter
+import multiprocessing as mp
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+# Runs many simulated robots popping jobs at once from separate processes, the
+# way gunicorn workers share one SQLite file, and checks that no job is handed
+# out twice. `--legacy` uses the old select-then-update pop for comparison.
+#
+#     cd webserver && python3 pop_benchmark.py --robots 64 --workers 4
+
+ROBOTS = 64
+JOBS_PER_ROBOT = 50
+WORKERS = 4
+
+
+def seed(path, robots, jobs_per_robot):
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO jobs (status, container, run_command, robot) "
+        "VALUES ('queued', 'bench', 'true', ?)",
+        [(f'robot{i % robots}',) for i in range(robots * jobs_per_robot)]
+    )
+    connection.commit()
+    connection.close()
+
+
+async def legacy_pop(robot_name, owner=None):
+    from db import database, jobs, STATUS
+
+    query = jobs.select().where(jobs.c.status == STATUS['QUEUED']) \
+                         .where(jobs.c.robot == robot_name) \
+                         .order_by(jobs.c.timestamp.asc())
+    job = await database.fetch_one(query)
+
+    if job is None:
+        return None
+
+    query = jobs.update().values(status=STATUS['RUNNING']) \
+                         .where(jobs.c.id == job.id)
+    await database.execute(query)
+
+    return job
+
+
+async def run_robots(robots, legacy):
+    import api
+    from db import database
+
+    pop = legacy_pop if legacy else api.pop
+    claimed, errors = [], 0
+
+    async def robot(name):
+        nonlocal errors
+        while True:
+            # Retries reuse the owner token, like the daemon does.
+            owner = uuid.uuid4().hex
+            while True:
+                try:
+                    job = await pop(name, owner)
+                    break
+                except sqlite3.OperationalError:
+                    errors += 1
+
+            if job is None:
+                return
+            claimed.append(job['id'])
+
+    await database.connect()
+    await asyncio.gather(*(robot(name) for name in robots))
+    await database.disconnect()
+
+    return claimed, errors
+
+
+def worker(robots, legacy, start, results):
+    start.wait()
+    results.put(asyncio.run(run_robots(robots, legacy)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark concurrent job pops.')
+    parser.add_argument('--robots', type=int, default=ROBOTS)
+    parser.add_argument('--jobs-per-robot', type=int, default=JOBS_PER_ROBOT)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--legacy', action='store_true',
+                        help='use the old select-then-update pop')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['HILL_DATABASE_URL'] = f'sqlite:///{path}'
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    import db  # creates the tables
+    db.engine.dispose()
+    seed(path, args.robots, args.jobs_per_robot)
+
+    # Every robot is simulated in every worker, like daemons whose requests
+    # are spread across all gunicorn workers.
+    robots = [f'robot{i}' for i in range(args.robots)]
+    ctx = mp.get_context('fork')
+    start, results = ctx.Event(), ctx.Queue()
+    processes = [
+        ctx.Process(target=worker, args=(robots, args.legacy, start, results))
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    begin = time.perf_counter()
+    start.set()
+    outcomes = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - begin
+
+    for process in processes:
+        process.join()
+
+    claims = Counter(job_id for claimed, _ in outcomes for job_id in claimed)
+    total = args.robots * args.jobs_per_robot
+    duplicates = sum(count - 1 for count in claims.values() if count > 1)
+    errors = sum(errors for _, errors in outcomes)
+
+    print(f'{"legacy" if args.legacy else "atomic"} pop, {args.robots} robots, '
+          f'{args.workers} workers: {len(claims)}/{total} jobs claimed in '
+          f'{elapsed:.2f} s ({sum(claims.values()) / elapsed:.0f} pops/s), '
+          f'{duplicates} duplicate claims, {errors} lock errors')
+
+    if duplicates:
+        raise SystemExit('Some jobs were handed out more than once.')
@@ -0,0 +1,167 @@
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+# Seeds a database with a long history, then times the queries behind the
+# queue, history, pop and activity routes before and after db.migrate adds the
+# indexes, printing SQLite's plan for each. The list routes are timed up to
+# their first PAGE rows, which is what a dashboard shows.
+#
+#     cd webserver && python3 query_benchmark.py
+#
+# The default 1M jobs and 10M activity rows take a few minutes to seed.
+
+JOBS = 1000000
+ACTIVITY = 10000000
+ROBOTS = 50
+QUEUED_FRACTION = 0.01
+PAGE = 100
+REPEATS = 20
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def seed(path, num_jobs, num_activity, robots):
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    connection = sqlite3.connect(path)
+
+    # Jobs are spread over a year, with the queued ones the most recent.
+    start = now - timedelta(days=365)
+    step = timedelta(days=365) / num_jobs
+    queued_from = int(num_jobs * (1 - QUEUED_FRACTION))
+
+    def jobs():
+        for i in range(num_jobs):
+            status = 'queued' if i >= queued_from else rng.choice(['finished', 'cancelled'])
+            yield ((start + i * step).strftime(TIME_FORMAT), status,
+                   f'robot{rng.randrange(robots)}')
+
+    connection.executemany(
+        "INSERT INTO jobs (timestamp, status, container, run_command, robot) "
+        "VALUES (?, ?, 'bench', 'true', ?)", jobs()
+    )
+
+    # Activity is one ping per robot per second, ending now.
+    def pings():
+        for i in range(num_activity):
+            seconds = (num_activity - i) // robots
+            yield ((now - timedelta(seconds=seconds)).strftime(TIME_FORMAT),
+                   f'robot{i % robots}')
+
+    connection.executemany(
+        "INSERT INTO activity (timestamp, robot) VALUES (?, ?)", pings()
+    )
+
+    # Which /activity/ reads, one row per robot, a minute apart.
+    connection.executemany(
+        "INSERT INTO robots (robot, last_seen) VALUES (?, ?)",
+        [(f'robot{i}', (now - timedelta(minutes=i)).strftime(TIME_FORMAT))
+         for i in range(robots)]
+    )
+    connection.commit()
+    connection.close()
+
+
+def route_queries(robot, num_jobs):
+    # The same queries as the routes in api.py.
+    import sqlalchemy
+    from db import jobs, robots, STATUS
+
+    old_time = datetime.utcnow() - timedelta(seconds=180)
+    # A page from the middle of the history, as a cursor would ask for.
+    cursor = sqlalchemy.tuple_(
+        sqlalchemy.literal((datetime.utcnow() - timedelta(days=180)).strftime(TIME_FORMAT)),
+        num_jobs // 2
+    )
+
+    return {
+        '/queue/': jobs.select().where(jobs.c.status == STATUS['QUEUED'])
+                                .order_by(jobs.c.timestamp.asc())
+                                .limit(PAGE),
+        '/queue/{robot}': jobs.select().where(jobs.c.status == STATUS['QUEUED'])
+                                       .where(jobs.c.robot == robot)
+                                       .order_by(jobs.c.timestamp.asc())
+                                       .limit(PAGE),
+        '/history/': jobs.select().where(jobs.c.status != STATUS['QUEUED'])
+                                  .order_by(jobs.c.timestamp.desc())
+                                  .limit(PAGE),
+        '/history/?cursor': jobs.select().where(jobs.c.status != STATUS['QUEUED'])
+                                         .where(sqlalchemy.tuple_(jobs.c.timestamp, jobs.c.id) < cursor)
+                                         .order_by(jobs.c.timestamp.desc(), jobs.c.id.desc())
+                                         .limit(PAGE),
+        '/history/{robot}': jobs.select().where(jobs.c.status != STATUS['QUEUED'])
+                                         .where(jobs.c.robot == robot)
+                                         .order_by(jobs.c.timestamp.desc())
+                                         .limit(PAGE),
+        '/pop/{robot}': sqlalchemy.select([jobs.c.id])
+                                  .where(jobs.c.status == STATUS['QUEUED'])
+                                  .where(jobs.c.robot == robot)
+                                  .order_by(jobs.c.timestamp.asc(), jobs.c.id.asc())
+                                  .limit(1),
+        '/activity/': sqlalchemy.select([robots.c.robot])
+                                .where(robots.c.last_seen > old_time)
+    }
+
+
+def time_queries(engine, robot, num_jobs):
+    import sqlalchemy
+
+    results = {}
+    with engine.connect() as connection:
+        for route, query in route_queries(robot, num_jobs).items():
+            compiled = query.compile(engine, compile_kwargs={'literal_binds': True})
+            explain = sqlalchemy.text(f'EXPLAIN QUERY PLAN {compiled}')
+            plan = connection.execute(explain).fetchall()
+
+            times = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                connection.execute(query).fetchall()
+                times.append(time.perf_counter() - start)
+
+            results[route] = (1000 * statistics.median(times),
+                              '; '.join(row[-1] for row in plan))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the route queries on a large database.')
+    parser.add_argument('--jobs', type=int, default=JOBS)
+    parser.add_argument('--activity', type=int, default=ACTIVITY)
+    parser.add_argument('--robots', type=int, default=ROBOTS)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['HILL_DATABASE_URL'] = f'sqlite:///{path}'
+
+    import db
+
+    # Start from a database as older versions left it, without indexes.
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(db.engine)
+
+    start = time.perf_counter()
+    seed(path, args.jobs, args.activity, args.robots)
+    print(f'Seeded {args.jobs} jobs and {args.activity} activity rows '
+          f'in {time.perf_counter() - start:.1f} s.')
+
+    robot = 'robot0'
+    before = time_queries(db.engine, robot, args.jobs)
+
+    start = time.perf_counter()
+    db.migrate(db.engine)
+    print(f'Migration took {time.perf_counter() - start:.1f} s.')
+
+    after = time_queries(db.engine, robot, args.jobs)
+
+    for route in before:
+        print(f'{route:>17}: {before[route][0]:9.2f} ms -> {after[route][0]:7.2f} ms'
+              f'   {after[route][1]}')
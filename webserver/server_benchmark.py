@@ -0,0 +1,448 @@
+import argparse
+from collections import defaultdict
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+import requests
+
+# Runs the server in this process against a temporary database, and drives
+# it from separate client processes with simulated daemons popping and
+# running jobs, researchers creating jobs and checking on them, and
+# dashboards following along. Reports requests per second and p50/p99
+# latency per route, and how long SQLite spent on each kind of statement.
+# Writes wait for the write lock before they run, so their time is mostly
+# lock wait.
+#
+#     cd webserver && python3 server_benchmark.py --save baseline.json
+#     python3 server_benchmark.py --compare baseline.json
+#
+# Comparing exits with an error if any route got slower, or got less done,
+# than the tolerance allows. Baselines only compare on the same machine with
+# the same scenario.
+
+DAEMONS = 16
+RESEARCHERS = 8
+DASHBOARDS = 16
+PROCESSES = 4
+DURATION = 30
+PORT = 8798
+SEED = 0
+
+POP_WAIT = 5 # seconds a daemon's pop is held open
+JOB_TIME = 2 # seconds each job runs, sending logs every second
+THINK_TIME = 1 # seconds between a researcher's rounds
+DASHBOARD_INTERVAL = 5 # seconds between polls of the old dashboard
+TOLERANCE = 0.25
+
+# Routes that are held open on purpose, so their latency isn't compared.
+LONG_POLLS = {'POST /pop/{robot}', 'GET /job/{id}/wait', 'GET /events/'}
+
+
+def make_zip(contents):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as f:
+        f.writestr('main.py', contents)
+    return buffer.getvalue()
+
+
+class Actor:
+    """
+    One simulated client, run on its own thread, which records the route,
+    duration and outcome of every request it makes.
+    """
+
+    def __init__(self, index, url, args, deadline, results):
+        self.index = index
+        self.url = url
+        self.args = args
+        self.deadline = deadline
+        self.results = results
+        self.rng = random.Random(args.seed * 1000003 + index)
+        self.session = requests.Session()
+
+    def request(self, method, route, path, expected=(), **kwargs):
+        # Returns the response if it succeeded, and None otherwise. Statuses
+        # in expected aren't counted as errors.
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.url + path, **kwargs)
+            ok = r.status_code < 400
+            expected = r.status_code in expected
+        except requests.exceptions.RequestException:
+            r, ok, expected = None, False, False
+
+        self.results.append((f'{method} {route}', time.perf_counter() - start, ok or expected))
+        return r if ok else None
+
+    def running(self):
+        return time.perf_counter() < self.deadline
+
+    def sleep(self, seconds):
+        time.sleep(max(0, min(seconds, self.deadline - time.perf_counter())))
+
+
+class Daemon(Actor):
+    # Pops with a long poll like daemon.run, and while a job runs, waits on
+    # its status and sends its logs every second.
+    def run(self):
+        robot = f'robot{self.index}'
+        output_zip = make_zip('results\n')
+
+        while self.running():
+            owner = uuid.uuid4().hex
+            r = self.request('POST', '/pop/{robot}', f'/pop/{robot}',
+                             params={'owner': owner, 'wait': self.args.pop_wait})
+            job = r.json() if r is not None else None
+            if job is None:
+                continue
+
+            path = f'/job/{job["id"]}'
+            watcher = threading.Thread(
+                target=self.request, args=('GET', '/job/{id}/wait', path + '/wait'),
+                kwargs={'params': {'status': 'running', 'timeout': self.args.job_time + 10}}
+            )
+            watcher.start()
+
+            offset = 0
+            for _ in range(self.args.job_time):
+                time.sleep(1)
+                chunk = b'step %d\n' % offset * 20
+                if self.request('POST', '/job/{id}/logs', path + '/logs',
+                                params={'offset': offset}, data=chunk) is not None:
+                    offset += len(chunk)
+
+            self.request('PUT', '/job/{id}', path, params={'job_status': 'finished'},
+                         files={'output_zip': output_zip})
+            watcher.join()
+
+
+class Researcher(Actor):
+    # Creates jobs the way `cli.py job create` does, then checks the queue,
+    # history and job like `cli.py queue`, `history` and `job read`.
+    def run(self):
+        code_zip = make_zip('print("hello")\n')
+        code_hash = hashlib.sha256(code_zip).hexdigest()
+
+        while self.running():
+            robot = f'robot{self.rng.randrange(self.args.daemons)}'
+            params = {'container': 'bench', 'mount': '/output', 'robot': robot,
+                      'run_command': 'true', 'code_hash': code_hash}
+
+            blob = self.request('GET', '/blob/{hash}', f'/blob/{code_hash}', expected=(404,))
+            if blob is not None:
+                r = self.request('POST', '/job/', '/job/', params=params)
+            else:
+                r = self.request('POST', '/job/', '/job/', params=params,
+                                 files={'code_zip': code_zip})
+
+            self.request('GET', '/queue/{robot}', f'/queue/{robot}')
+            self.request('GET', '/history/{robot}', f'/history/{robot}')
+            if r is not None:
+                self.request('GET', '/job/{id}', f'/job/{r.json()["id"]}')
+
+            self.sleep(self.args.think_time * self.rng.uniform(0.5, 1.5))
+
+
+class Dashboard(Actor):
+    # Follows /events/ like static/custom.js, loading the lists whenever the
+    # stream resets. With --poll-dashboards, polls every few seconds like
+    # the dashboard used to, sending back ETags like a browser.
+    def run(self):
+        if self.args.poll_dashboards:
+            self.poll()
+        else:
+            self.follow()
+
+    def load(self, etags=None):
+        for route, path in [('/queue/', '/queue/'),
+                            ('/history/', '/history/'),
+                            ('/history/?fields', '/history/?fields=robot,status'),
+                            ('/activity/', '/activity/')]:
+            headers = {}
+            if etags is not None and path in etags:
+                headers['If-None-Match'] = etags[path]
+
+            r = self.request('GET', route, path, headers=headers)
+            if etags is not None and r is not None and 'etag' in r.headers:
+                etags[path] = r.headers['etag']
+
+    def poll(self):
+        etags = {}
+        self.sleep(self.rng.uniform(0, self.args.dashboard_interval))
+        while self.running():
+            self.load(etags)
+            self.sleep(self.args.dashboard_interval)
+
+    def follow(self):
+        start = time.perf_counter()
+        try:
+            r = self.session.get(self.url + '/events/', stream=True)
+        except requests.exceptions.RequestException:
+            self.results.append(('GET /events/', time.perf_counter() - start, False))
+            return
+
+        # The stream is cut off at the deadline, ending the loop below.
+        closer = threading.Timer(max(0, self.deadline - time.perf_counter()), r.close)
+        closer.start()
+
+        events = 0
+        try:
+            buffer = b''
+            for chunk in r.iter_content(chunk_size=None):
+                buffer += chunk
+                while b'\n\n' in buffer:
+                    message, buffer = buffer.split(b'\n\n', 1)
+                    for line in message.split(b'\n'):
+                        if line.startswith(b'data: '):
+                            events += 1
+                            if json.loads(line[6:])['kind'] == 'reset':
+                                self.load()
+        except Exception:
+            pass # closed at the deadline
+        finally:
+            closer.cancel()
+
+        self.results.append(('GET /events/', time.perf_counter() - start, True))
+        self.results.append(('events received', events, True))
+
+
+def client_process(url, args, actors, start, queue):
+    start.wait()
+    deadline = time.perf_counter() + args.duration
+    results = []
+
+    threads = [
+        threading.Thread(target=kind(index, url, args, deadline, results).run)
+        for kind, index in actors
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    queue.put(results)
+
+
+class StatementTimer:
+    """
+    Times every statement SQLite runs for the server, on the thread that
+    runs it, by kind of statement.
+    """
+
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def install(self):
+        import aiosqlite
+
+        original = aiosqlite.Connection._execute
+        timer = self
+
+        async def _execute(connection, fn, *args, **kwargs):
+            def timed():
+                begin = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    timer.record(args, time.perf_counter() - begin)
+            return await original(connection, timed)
+
+        aiosqlite.Connection._execute = _execute
+
+    def record(self, args, elapsed):
+        if not args or not isinstance(args[0], str):
+            return
+
+        verb = args[0].lstrip().split(None, 1)[0].upper()
+        if verb in ('INSERT', 'UPDATE', 'DELETE'):
+            kind = 'write'
+        elif verb in ('SELECT', 'WITH'):
+            kind = 'read'
+        else:
+            kind = verb.lower()
+        self.times[kind].append(elapsed)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+def summarize(results, statements, args):
+    routes = defaultdict(list)
+    events = 0
+    for route, elapsed, ok in results:
+        if route == 'events received':
+            events += elapsed
+        else:
+            routes[route].append((elapsed, ok))
+
+    summary = {
+        'scenario': {name: getattr(args, name) for name in (
+            'daemons', 'researchers', 'dashboards', 'duration', 'pop_wait',
+            'job_time', 'think_time', 'dashboard_interval', 'poll_dashboards', 'seed'
+        )},
+        'throughput': sum(len(samples) for samples in routes.values()) / args.duration,
+        'events': events,
+        'routes': {},
+        'statements': {}
+    }
+
+    for route, samples in sorted(routes.items()):
+        times = [1000 * elapsed for elapsed, _ in samples]
+        summary['routes'][route] = {
+            'count': len(samples),
+            'rate': len(samples) / args.duration,
+            'p50': statistics.median(times),
+            'p99': percentile(times, 0.99),
+            'errors': sum(not ok for _, ok in samples)
+        }
+
+    for kind, times in sorted(statements.items()):
+        times = [1000 * elapsed for elapsed in times]
+        summary['statements'][kind] = {
+            'count': len(times),
+            'total': sum(times) / 1000,
+            'p50': statistics.median(times),
+            'p99': percentile(times, 0.99)
+        }
+
+    return summary
+
+
+def report(summary):
+    print(f'{summary["throughput"]:.0f} requests/s, {summary["events"]} events streamed')
+    print(f'{"route":>22} {"count":>7} {"per s":>7} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for route, stats in summary['routes'].items():
+        print(f'{route:>22} {stats["count"]:7d} {stats["rate"]:7.1f} '
+              f'{stats["p50"]:8.1f} {stats["p99"]:8.1f} {stats["errors"]:7d}')
+
+    print(f'{"statement":>22} {"count":>7} {"total s":>7} {"p50 ms":>8} {"p99 ms":>8}')
+    for kind, stats in summary['statements'].items():
+        print(f'{kind:>22} {stats["count"]:7d} {stats["total"]:7.2f} '
+              f'{stats["p50"]:8.2f} {stats["p99"]:8.2f}')
+
+
+def compare(summary, baseline, tolerance):
+    # Returns the regressions against the baseline, printing every change.
+    if summary['scenario'] != baseline['scenario']:
+        print('Warning: the baseline was run with a different scenario.')
+
+    regressions = []
+    for route, base in baseline['routes'].items():
+        stats = summary['routes'].get(route)
+        if stats is None:
+            continue
+
+        checks = [('per s', stats['rate'], base['rate'], -1)]
+        if route not in LONG_POLLS:
+            checks += [('p50', stats['p50'], base['p50'], 1),
+                       ('p99', stats['p99'], base['p99'], 1)]
+
+        for name, value, old, sign in checks:
+            if old == 0:
+                continue
+
+            change = (value - old) / old
+            worse = sign * change > tolerance
+            print(f'{route:>22} {name:>6}: {old:8.1f} -> {value:8.1f} '
+                  f'({100 * change:+.0f}%){"  REGRESSION" if worse else ""}')
+            if worse:
+                regressions.append((route, name))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the server under simulated use.')
+    parser.add_argument('--daemons', type=int, default=DAEMONS)
+    parser.add_argument('--researchers', type=int, default=RESEARCHERS)
+    parser.add_argument('--dashboards', type=int, default=DASHBOARDS)
+    parser.add_argument('--processes', type=int, default=PROCESSES,
+                        help='client processes the simulated users are spread over')
+    parser.add_argument('--duration', type=int, default=DURATION)
+    parser.add_argument('--pop-wait', type=float, default=POP_WAIT)
+    parser.add_argument('--job-time', type=int, default=JOB_TIME)
+    parser.add_argument('--think-time', type=float, default=THINK_TIME)
+    parser.add_argument('--dashboard-interval', type=float, default=DASHBOARD_INTERVAL)
+    parser.add_argument('--poll-dashboards', action='store_true',
+                        help='poll like the dashboard did before /events/')
+    parser.add_argument('--database', help='database URL instead of a temporary SQLite file')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='largest relative change not counted as a regression')
+    args = parser.parse_args()
+
+    # The server keeps its files in the current directory, so it runs in a
+    # temporary one that only links to the dashboard.
+    here = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    for name in ('static', 'index.html'):
+        os.symlink(os.path.join(here, name), os.path.join(directory, name))
+    os.chdir(directory)
+    os.environ['HILL_DATABASE_URL'] = args.database or f'sqlite:///{directory}/hill.db'
+
+    # Clients are forked before the server starts any threads.
+    url = f'http://127.0.0.1:{args.port}'
+    actors = [(Daemon, i) for i in range(args.daemons)] + \
+             [(Researcher, i) for i in range(args.researchers)] + \
+             [(Dashboard, i) for i in range(args.dashboards)]
+    ctx = mp.get_context('fork')
+    start, queue = ctx.Event(), ctx.Queue()
+    processes = [
+        ctx.Process(target=client_process,
+                    args=(url, args, actors[i::args.processes], start, queue))
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    import uvicorn
+    import api
+
+    statements = StatementTimer()
+    statements.install()
+    server = uvicorn.Server(uvicorn.Config(api.app, host='127.0.0.1', port=args.port,
+                                           log_level='warning', access_log=False))
+    results = []
+
+    def coordinate():
+        while not server.started:
+            time.sleep(0.05)
+        start.set()
+        for _ in processes:
+            results.extend(queue.get())
+        server.should_exit = True
+
+    threading.Thread(target=coordinate, daemon=True).start()
+    server.run()
+
+    for process in processes:
+        process.join()
+
+    summary = summarize(results, statements.times, args)
+    report(summary)
+
+    if args.save:
+        with open(os.path.join(cwd, args.save), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.compare:
+        with open(os.path.join(cwd, args.compare)) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(f'{len(regressions)} regressions beyond {100 * args.tolerance:.0f}%.')
@@ -6,7 +6,25 @@ const robot_buttons = document.getElementsByClassName('robot-button');
 
 let selected_robot = '';
 let known_robots = new Set();
-let running_robots = new Set();
+let robots_seen = new Map(); // robot -> when it last polled, in ms
+let running_jobs = new Map(); // robot -> ids of its running jobs
+let shown_jobs = new Map(); // job id -> its card
+
+// Robots that polled this recently are shown as active.
+const ACTIVE_TIME = 180*1000;
+// Past jobs beyond this many are dropped from the page as new ones come in.
+const PAST_JOBS = 100;
+
+// Logs are only fetched for the jobs whose log panel has been opened, and
+// after that only the new part of them. Logs of running jobs are followed
+// as they are written.
+let open_logs = new Set();
+let loaded_logs = new Map(); // job id -> {text, size}
+let log_streams = new Map(); // job id -> AbortController
+
+// Events that arrive while the lists are being loaded are held until the
+// load is done, and then applied on top of it.
+let pending_events = null;
 
 const createNode = (element) => {
     return document.createElement(element);
@@ -41,17 +59,36 @@ const build_card = (job) => {
             </dl>
     `
 
-    if (job.status === 'finished' || job.status === 'canceled') {
+    if (job.status !== 'queued') {
         div.innerHTML += `
             <ul class='uk-width-1-1' uk-accordion>
-                <li>
+                <li class='${open_logs.has(job.id) ? 'uk-open' : ''}'>
                     <a class="uk-accordion-title" href="#">Logs</a>
                     <div class="uk-accordion-content">
-                        <pre><code>${job.logs}</code></pre>
+                        <pre><code></code></pre>
                     </div>
                 </li>
             </ul>
         `
+
+        let code = div.querySelector('code');
+        if (loaded_logs.has(job.id)) {
+            code.textContent = loaded_logs.get(job.id).text;
+        }
+
+        div.querySelector('.uk-accordion-title').onclick = () => {
+            if (open_logs.has(job.id)) {
+                open_logs.delete(job.id);
+                stop_logs(job.id);
+            } else {
+                open_logs.add(job.id);
+                fetch_logs(job, code);
+            }
+        }
+
+        if (open_logs.has(job.id)) {
+            fetch_logs(job, code);
+        }
     }
 
     let li = createNode('li');
@@ -60,8 +97,50 @@ const build_card = (job) => {
     return li;
 }
 
-const build_robots = (robot, active) => {
-    let running = running_robots.has(robot);
+const stop_logs = (job_id) => {
+    if (log_streams.has(job_id)) {
+        log_streams.get(job_id).abort();
+        log_streams.delete(job_id);
+    }
+}
+
+const fetch_logs = (job, code) => {
+    stop_logs(job.id);
+
+    let logs = loaded_logs.get(job.id) || {text: '', size: 0};
+    let follow = job.status === 'running';
+    let controller = new AbortController();
+    log_streams.set(job.id, controller);
+
+    fetch(`${API_HOST}/job/${job.id}/logs?offset=${logs.size}&follow=${follow}`,
+          {signal: controller.signal})
+    .then((resp) => {
+        let reader = resp.body.getReader();
+        let decoder = new TextDecoder();
+
+        const read = () => reader.read().then(({done, value}) => {
+            if (done) {
+                return;
+            }
+            logs = {text: logs.text + decoder.decode(value, {stream: true}),
+                    size: logs.size + value.byteLength};
+            loaded_logs.set(job.id, logs);
+            code.textContent = logs.text;
+            return read();
+        });
+        return read();
+    })
+    .catch(function(error) {
+        if (error.name !== 'AbortError') {
+            console.log('Error when pulling logs.');
+            console.log(error);
+        }
+    });
+}
+
+const build_robots = (robot) => {
+    let running = (running_jobs.get(robot) || new Set()).size > 0;
+    let active = Date.now() - (robots_seen.get(robot) || 0) < ACTIVE_TIME;
     let li = createNode('li');
     li.setAttribute('data-tags', running ? 'running' : active ? 'active' : 'stale');
     li.innerHTML = `
@@ -76,97 +155,179 @@ const build_robots = (robot, active) => {
 
     li.onclick = () => {
         selected_robot = robot;
-        fill_everything();
+        load_everything();
     }
 
     return li;
 }
 
-const fill_queue = (robot_name) => {
-    fetch(`${API_HOST}/queue/${robot_name}`)
-    .then((resp) => resp.json())
-    .then(function(jobs) {
-        queue_list.innerHTML = '';
-        return jobs.map(function(job) {
-            known_robots.add(job.robot);
-            append(queue_list, build_card(job));
-        });
-    })
-    .catch(function(error) {
-        console.log('Error when pulling queue.');
-        console.log(error);
+const fill_robots = () => {
+    robots_list.innerHTML = '';
+
+    let li = createNode('li');
+    li.setAttribute('data-tags', 'active stale running');
+    li.innerHTML = `
+        <div class='uk-card uk-card-small uk-card-primary uk-card-body robot-button'>All Robots</div>
+    `
+    li.onclick = () => {
+        selected_robot = '';
+        load_everything();
+    }
+
+    append(robots_list, li);
+
+    [...known_robots].sort().forEach((robot) => {
+        append(robots_list, build_robots(robot));
     });
 }
 
-const fill_history = (robot_name) => {
-    fetch(`${API_HOST}/history/${robot_name}`)
-    .then((resp) => resp.json())
-    .then(function(jobs) {
-        running_list.innerHTML = '';
-        past_list.innerHTML = '';
+const set_running = (job_id, robot, running) => {
+    if (!running_jobs.has(robot)) {
+        running_jobs.set(robot, new Set());
+    }
 
-        if (robot_name !== '') {
-            running_robots.delete(robot_name);
-        } else {
-            running_robots.clear();
-        }
-        return jobs.map(function(job) {
-            known_robots.add(job.robot);
+    let ids = running_jobs.get(robot);
+    let was_running = ids.size > 0;
+    if (running) {
+        ids.add(job_id);
+    } else {
+        ids.delete(job_id);
+    }
 
-            if (job.status === 'running') {
-                running_robots.add(job.robot);
-                append(running_list, build_card(job))
-            } else {
-                append(past_list, build_card(job));
-            }
-        });
-    })
-    .catch(function(error) {
-        console.log('Error when pulling history.');
-        console.log(error);
+    if (!known_robots.has(robot) || was_running !== ids.size > 0) {
+        known_robots.add(robot);
+        fill_robots();
+    }
+}
+
+// Queued jobs are listed oldest first, and the others newest first.
+const list_for = (job) => {
+    if (job.status === 'queued') {
+        return queue_list;
+    }
+    return job.status === 'running' ? running_list : past_list;
+}
+
+const comes_before = (a, b) => {
+    let order = a.timestamp < b.timestamp || (a.timestamp === b.timestamp && a.id < b.id);
+    return a.status === 'queued' ? order : !order;
+}
+
+const remove_job = (job_id) => {
+    if (shown_jobs.has(job_id)) {
+        shown_jobs.get(job_id).li.remove();
+        shown_jobs.delete(job_id);
+    }
+    stop_logs(job_id);
+}
+
+const show_job = (job) => {
+    remove_job(job.id);
+    if (selected_robot !== '' && job.robot !== selected_robot) {
+        return;
+    }
+
+    let list = list_for(job);
+    let li = build_card(job);
+    let next = [...list.children].find((other) => {
+        let shown = shown_jobs.get(parseInt(other.dataset.id));
+        return shown !== undefined && comes_before(job, shown.job);
     });
+
+    li.dataset.id = job.id;
+    list.insertBefore(li, next || null);
+    shown_jobs.set(job.id, {job: job, li: li});
+
+    while (list === past_list && list.children.length > PAST_JOBS) {
+        remove_job(parseInt(list.lastElementChild.dataset.id));
+    }
 }
 
-const fill_robots = () => {
-    fetch(`${API_HOST}/activity/`)
-    .then((resp) => resp.json())
-    .then(function(active_robots) {
-        active_robots.forEach((robot, _) => {
-            known_robots.add(robot);
-        });
+const apply_event = (event) => {
+    if (event.kind === 'reset') {
+        load_everything();
+        return;
+    }
 
-        robots_list.innerHTML = '';
-        
-        let li = createNode('li');
-        li.setAttribute('data-tags', 'active stale running');
-        li.innerHTML = `
-            <div class='uk-card uk-card-small uk-card-primary uk-card-body robot-button'>All Robots</div>
-        `
-        li.onclick = () => {
-            selected_robot = '';
-            fill_everything();
+    if (event.kind === 'heartbeat') {
+        robots_seen.set(event.robot, Date.parse(event.timestamp + 'Z'));
+        known_robots.add(event.robot);
+        fill_robots();
+        return;
+    }
+
+    // Any other event is a change to a job, sent as the job is now.
+    if (event.job !== null) {
+        set_running(event.job.id, event.job.robot, event.job.status === 'running');
+        show_job(event.job);
+    } else {
+        set_running(event.job_id, event.robot, false);
+        remove_job(event.job_id);
+    }
+}
+
+const fetch_json = (path) => {
+    return fetch(`${API_HOST}${path}`).then((resp) => resp.json());
+}
+
+const load_everything = () => {
+    let loading = pending_events = [];
+
+    Promise.all([
+        fetch_json(`/queue/${selected_robot}`),
+        fetch_json(`/history/${selected_robot}`),
+        fetch_json('/history/?fields=robot,status'),
+        fetch_json('/activity/')
+    ])
+    .then(([queue, history, all_history, active_robots]) => {
+        // A newer load was started in the meantime.
+        if (pending_events !== loading) {
+            return;
         }
 
-        append(robots_list, li);
+        [...shown_jobs.keys()].forEach(remove_job);
+        queue_list.innerHTML = '';
+        running_list.innerHTML = '';
+        past_list.innerHTML = '';
 
-        return [...known_robots].sort().map((robot) => {
-            append(robots_list, build_robots(robot, active_robots.includes(robot)));
+        running_jobs.clear();
+        all_history.concat(history).forEach((job) => {
+            known_robots.add(job.robot);
+            set_running(job.id, job.robot, job.status === 'running');
         });
+        active_robots.forEach((robot) => {
+            known_robots.add(robot);
+            robots_seen.set(robot, Math.max(robots_seen.get(robot) || 0, Date.now()));
+        });
+
+        queue.concat(history).forEach((job) => {
+            known_robots.add(job.robot);
+            show_job(job);
+        });
+        fill_robots();
+
+        pending_events = null;
+        loading.forEach(apply_event);
     })
     .catch(function(error) {
-        console.log('Error when pulling active robots.');
+        console.log('Error when loading jobs.');
         console.log(error);
+        pending_events = null;
     });
 }
 
-const fill_everything = () => {
-    fill_queue(selected_robot);
-    fill_history(selected_robot);
-    fill_robots();
+// Changes are pushed by the server as they happen. The browser reconnects
+// by itself, and the server either replays what was missed or starts the
+// stream with a reset, which loads everything afresh.
+const events = new EventSource(`${API_HOST}/events/`);
+events.onmessage = (message) => {
+    let event = JSON.parse(message.data);
+    if (pending_events !== null && event.kind !== 'reset') {
+        pending_events.push(event);
+    } else {
+        apply_event(event);
+    }
 }
 
-// Regularly update.
-window.setInterval(fill_everything, 1000*5);
-
-// On initial load.
-fill_everything();
+// Robots that stop polling turn inactive without any event.
+window.setInterval(fill_robots, 1000*30);
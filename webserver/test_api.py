@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import sys
+
+from fastapi.testclient import TestClient
+import pytest
+
+# Run from webserver with `python3 -m pytest`. The server runs against a new
+# database in a temporary directory, set up before api is first imported.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('server')
+    for name in ('static', 'index.html'):
+        os.symlink(os.path.join(HERE, name), os.path.join(directory, name))
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    os.environ['HILL_DATABASE_URL'] = f'sqlite:///{directory}/hill.db'
+    sys.path.insert(0, HERE)
+
+    import api
+    with TestClient(api.app) as client:
+        yield client
+
+    os.chdir(cwd)
+
+
+def on_app_loop(client, function, *args):
+    # Database connections belong to the loop serving the app, so coroutines
+    # that use them run there too.
+    portal = getattr(client, 'portal', None)
+    if portal is not None:
+        return portal.call(function, *args)
+    return asyncio.get_event_loop().run_until_complete(function(*args))
+
+
+def create_job(client, robot):
+    params = {'container': 'test', 'mount': '/output', 'robot': robot,
+              'run_command': 'true'}
+    r = client.post('/job/', params=params, files={'code_zip': ('code.zip', b'code')})
+    assert r.status_code == 200
+    return r.json()
+
+
+@pytest.fixture(scope='module')
+def robot_jobs(client):
+    # One job finished, and one still queued, on the same robot.
+    finished = create_job(client, 'lists')
+    r = client.post('/pop/lists', params={'owner': 'test'})
+    assert r.json()['id'] == finished['id']
+    r = client.put(f'/job/{finished["id"]}', params={'job_status': 'finished'},
+                   files={'output_zip': ('output.zip', b'output')})
+    assert r.status_code == 200
+
+    queued = create_job(client, 'lists')
+    return queued, finished
+
+
+@pytest.mark.parametrize('path', ['/queue/', '/queue/lists', '/history/', '/history/lists'])
+def test_lists_leave_out_logs_by_default(client, robot_jobs, path):
+    r = client.get(path)
+    assert r.status_code == 200
+
+    jobs = [job for job in r.json() if job['robot'] == 'lists']
+    assert len(jobs) == 1
+    assert jobs[0]['status'] == ('queued' if path.startswith('/queue/') else 'finished')
+    assert 'logs' not in jobs[0]
+
+
+@pytest.mark.parametrize('path', ['/queue/', '/queue/lists', '/history/', '/history/lists'])
+def test_lists_read_only_the_fields_asked_for(client, robot_jobs, path):
+    r = client.get(path, params={'fields': 'robot'})
+    assert r.status_code == 200
+    assert r.json()
+    assert all(set(job) == {'id', 'timestamp', 'robot'} for job in r.json())
+
+    r = client.get(path, params={'fields': 'robot', 'include_logs': True})
+    assert all(set(job) == {'id', 'timestamp', 'robot', 'logs'} for job in r.json())
+
+
+def test_lists_reject_unknown_fields(client):
+    assert client.get('/queue/', params={'fields': 'robot,nonsense'}).status_code == 400
+
+
+def test_events_carry_the_job_as_it_is_now(client):
+    import api
+
+    job = create_job(client, 'events')
+    client.post(f'/job/{job["id"]}/cancel')
+
+    query = api.events.select().where(api.events.c.job_id == job['id']) \
+                               .order_by(api.events.c.id.asc())
+    rows = on_app_loop(client, api.database.fetch_all, query)
+    messages = on_app_loop(client, api.event_messages, rows)
+
+    events = [json.loads(text.split('data: ', 1)[1]) for _, text in messages]
+    assert [event['kind'] for event in events] == ['created', 'cancelled']
+    assert all(event['job']['id'] == job['id'] for event in events)
+    assert all(event['job']['status'] == 'cancelled' for event in events)
+
+
+def test_idle_pop_returns_no_job(client):
+    r = client.post('/pop/idle', params={'owner': 'idle', 'wait': 0.1})
+    assert r.status_code == 200
+    assert r.json() is None
@@ -0,0 +1,36 @@
+import os
+
+from events import Notifier
+
+
+def pin_mtime(path):
+    # Stands in for a filesystem whose timestamps only change once a tick.
+    os.utime(path, ns=(0, 0))
+
+
+def test_notifications_in_one_tick_are_told_apart(tmp_path):
+    path = str(tmp_path / 'events')
+    watcher, other = Notifier(path), Notifier(path)
+
+    other.notify('robot')
+    pin_mtime(path)
+    seen = watcher.file_signature()
+
+    other.notify('robot')
+    pin_mtime(path)
+    assert watcher.file_signature() != seen
+
+
+def test_notify_file_stays_small(tmp_path):
+    path = str(tmp_path / 'events')
+    notifier = Notifier(path, max_size=8)
+
+    seen = notifier.file_signature()
+    for _ in range(20):
+        notifier.notify('robot')
+        pin_mtime(path)
+        assert os.path.getsize(path) < 8
+
+        # Truncating repeats sizes, but never the one just seen.
+        assert notifier.file_signature() != seen
+        seen = notifier.file_signature()